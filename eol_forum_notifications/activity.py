@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+"""
+    Forum activity counters buffered in the django cache.
+
+    record_activity() increments the cache counters of a discussion and registers
+    the discussion in a dirty index, flush_activity() moves the buffered counts to
+    EolForumNotificationsDiscussions with one UPDATE (F expressions) per discussion.
+    It runs in task_flush_activity and before every notification run.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from opaque_keys.edx.keys import CourseKey
+from .models import EolForumNotificationsDiscussions
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ACTIVITY_KINDS = ('threads', 'comment')
+ACTIVITY_PREFIX = 'eol_forum_notifications:activity'
+ACTIVITY_TIMEOUT = 7 * 24 * 60 * 60
+ACTIVITY_FLUSH_EVERY = 100
+ACTIVITY_FLUSH_CHUNK_SIZE = 500
+ACTIVITY_LOCK_TIMEOUT = 5 * 60
+ACTIVITY_GAP_TIMEOUT = 60
+
+
+def record_activity(course_id, discussion_id, kind):
+    """
+        count a new thread or comment ('threads' or 'comment') of the discussion,
+        daily and weekly counters are updated together on flush
+    """
+    if kind not in ACTIVITY_KINDS:
+        raise ValueError('kind must be one of {}'.format(ACTIVITY_KINDS))
+    key = _get_discussion_key(course_id, discussion_id)
+    try:
+        cache.add(_get_counter_key(key, kind), 0, ACTIVITY_TIMEOUT)
+        cache.incr(_get_counter_key(key, kind))
+        position = None
+        # a flush can read the reserved position before the entry is set,
+        # flush_activity() keeps the position until the entry appears or the gap times out
+        if cache.add('{}:pending:{}'.format(ACTIVITY_PREFIX, key), True, ACTIVITY_TIMEOUT):
+            cache.add('{}:seq'.format(ACTIVITY_PREFIX), 0, None)
+            position = cache.incr('{}:seq'.format(ACTIVITY_PREFIX))
+            cache.set(_get_dirty_key(position), (str(course_id), discussion_id), ACTIVITY_TIMEOUT)
+    except ValueError:
+        # key evicted or cache without incr support, write the increment directly
+        logger.info('EolForumNotification - Activity cache unavailable, course: {}, discussion_id: {}'.format(course_id, discussion_id))
+        _update_counters(str(course_id), discussion_id, {kind: 1})
+        return
+    if position is not None and position % getattr(settings, 'EOL_FORUM_NOTIFICATIONS_ACTIVITY_FLUSH_EVERY', ACTIVITY_FLUSH_EVERY) == 0:
+        # flushed by a worker, the forum post does not wait for it
+        from .tasks import task_flush_activity
+        try:
+            task_flush_activity.delay()
+        except Exception as e:
+            logger.info('EolForumNotification - Error to enqueue activity flush, error: {}'.format(str(e)))
+
+def flush_activity():
+    """
+        write the buffered counters to the database, return the number of discussions updated
+    """
+    lock_key = '{}:lock'.format(ACTIVITY_PREFIX)
+    if not cache.add(lock_key, True, ACTIVITY_LOCK_TIMEOUT):
+        logger.info('EolForumNotification - Activity flush already running')
+        return 0
+    try:
+        last = cache.get('{}:seq'.format(ACTIVITY_PREFIX)) or 0
+        flushed = cache.get('{}:flushed'.format(ACTIVITY_PREFIX)) or 0
+        if last < flushed:
+            # the sequence was evicted and started again
+            logger.info('EolForumNotification - Activity sequence reset, seq: {}, flushed: {}'.format(last, flushed))
+            flushed = 0
+            cache.delete('{}:gap'.format(ACTIVITY_PREFIX))
+        # positions reserved before a gap older than ACTIVITY_GAP_TIMEOUT whose entry is still missing are lost
+        gap = cache.get('{}:gap'.format(ACTIVITY_PREFIX))
+        lost_until = gap[0] if gap and time.time() - gap[1] > ACTIVITY_GAP_TIMEOUT else 0
+        first_missing = None
+        updated = 0
+        for start in range(flushed + 1, last + 1, ACTIVITY_FLUSH_CHUNK_SIZE):
+            positions = range(start, min(start + ACTIVITY_FLUSH_CHUNK_SIZE, last + 1))
+            entries = cache.get_many([_get_dirty_key(i) for i in positions])
+            if first_missing is None:
+                first_missing = next((i for i in positions if i > lost_until and _get_dirty_key(i) not in entries), None)
+            for course_id, discussion_id in set(entries.values()):
+                key = _get_discussion_key(course_id, discussion_id)
+                # unmark first, activity recorded from now on registers the discussion again
+                cache.delete('{}:pending:{}'.format(ACTIVITY_PREFIX, key))
+                counts = {}
+                for kind in ACTIVITY_KINDS:
+                    count = cache.get(_get_counter_key(key, kind)) or 0
+                    if count:
+                        cache.decr(_get_counter_key(key, kind), count)
+                        counts[kind] = count
+                if counts:
+                    _update_counters(course_id, discussion_id, counts)
+                    updated += 1
+            # entries after a gap are kept, flushing them again only finds empty counters
+            done = positions[-1] if first_missing is None else first_missing - 1
+            cache.delete_many([_get_dirty_key(i) for i in positions if i <= done])
+            if done >= start:
+                cache.set('{}:flushed'.format(ACTIVITY_PREFIX), done, None)
+        if first_missing is None:
+            cache.delete('{}:gap'.format(ACTIVITY_PREFIX))
+        elif not gap or lost_until:
+            cache.set('{}:gap'.format(ACTIVITY_PREFIX), (last, time.time()), None)
+        if updated:
+            logger.info('EolForumNotification - Activity flushed, discussions: {}'.format(updated))
+        return updated
+    finally:
+        cache.delete(lock_key)
+
+def _update_counters(course_id, discussion_id, counts):
+    """
+        increment daily and weekly counters of the discussion and mark them pending in one UPDATE
+    """
+    values = {
+        'daily_pending': True,
+        'weekly_pending': True
+    }
+    for kind, count in counts.items():
+        values['daily_{}'.format(kind)] = F('daily_{}'.format(kind)) + count
+        values['weekly_{}'.format(kind)] = F('weekly_{}'.format(kind)) + count
+    EolForumNotificationsDiscussions.objects.filter(
+        discussion_id=discussion_id,
+        course_id=CourseKey.from_string(course_id)).update(**values)
+
+def _get_discussion_key(course_id, discussion_id):
+    """
+        return a short cache safe key of the discussion
+    """
+    return hashlib.md5('{}:{}'.format(course_id, discussion_id).encode('utf-8')).hexdigest()
+
+def _get_counter_key(key, kind):
+    """
+        return cache key of the discussion counter of kind
+    """
+    return '{}:count:{}:{}'.format(ACTIVITY_PREFIX, key, kind)
+
+def _get_dirty_key(position):
+    """
+        return cache key of the dirty index entry at position
+    """
+    return '{}:dirty:{}'.format(ACTIVITY_PREFIX, position)
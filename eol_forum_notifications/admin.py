@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions
+from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions, NotificationRun
 # Register your models here.
 
 class EolForumNotificationsDiscussionsAdmin(admin.ModelAdmin):
@@ -9,7 +9,13 @@ class EolForumNotificationsDiscussionsAdmin(admin.ModelAdmin):
 class EolForumNotificationsUserAdmin(admin.ModelAdmin):
     raw_id_fields = ('user', 'discussion')
     list_display = ('user', 'discussion', 'how_often')
-    search_fields = ['user__username', 'discussion__course_id', 'how_often']
+    list_filter = ['how_often']
+    search_fields = ['user__username', 'discussion__course_id']
+
+class NotificationRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'how_often', 'digest', 'shards', 'shard_index', 'started_at', 'finished_at')
+    list_filter = ['how_often', 'digest']
 
 admin.site.register(EolForumNotificationsDiscussions, EolForumNotificationsDiscussionsAdmin)
-admin.site.register(EolForumNotificationsUser, EolForumNotificationsUserAdmin)
\ No newline at end of file
+admin.site.register(EolForumNotificationsUser, EolForumNotificationsUserAdmin)
+admin.site.register(NotificationRun, NotificationRunAdmin)
\ No newline at end of file
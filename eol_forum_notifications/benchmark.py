@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+"""
+    Benchmarks of the notification pipeline, run with the
+    discussion_notification_benchmark command
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from django.db import transaction
+from unittest.mock import patch
+import time
+
+BENCHMARK_SCALES = [(1, 10, 10), (5, 20, 50), (10, 50, 100)]
+BENCHMARK_PREFIX = 'eolbenchmark'
+BENCHMARK_VIEW_REQUESTS = 20
+
+
+def get_email_context(index, discussion_id='benchmark-discussion', course_id='course-v1:eol+benchmark+2024'):
+    """
+        return a synthetic email context
+    """
+    return {
+        'user_id': index,
+        'email': 'benchmark{}@example.com'.format(index),
+        'course_name': 'Benchmark course',
+        'image': '/assets/image.jpg',
+        'platform_name': 'Benchmark',
+        'url_site': 'https://benchmark.test',
+        'how_often': 'daily',
+        'discussion_name': 'Benchmark discussion',
+        'parent': 'block-v1:eol+benchmark+2024+type@vertical+block@benchmark',
+        'course_id': course_id,
+        'notif_url': 'https://benchmark.test/eol_discussion_notification/get_save/?user_id={}'.format(index),
+        'discussion_id': discussion_id,
+        'daily_threads': 3,
+        'daily_comment': 5,
+        'weekly_threads': 3,
+        'weekly_comment': 5
+    }
+
+def get_rate(count, seconds):
+    """
+        return timing summary of count operations
+    """
+    return {
+        'seconds': round(seconds, 4),
+        'per_second': round(count / seconds, 2) if seconds else None
+    }
+
+def benchmark_email(recipients=1000, chunk_size=50):
+    """
+        compare task_send_single_email and task_send_bulk_email throughput
+        using the configured EMAIL_BACKEND (e.g. a local SMTP stand-in)
+    """
+    from .tasks import task_send_single_email, task_send_bulk_email
+    contexts = [get_email_context(i) for i in range(recipients)]
+    start = time.perf_counter()
+    for context in contexts:
+        task_send_single_email(context['discussion_id'], context['course_id'], context)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(0, recipients, chunk_size):
+        task_send_bulk_email(contexts[i:i + chunk_size])
+    bulk = time.perf_counter() - start
+    return {
+        'recipients': recipients,
+        'chunk_size': chunk_size,
+        'single': get_rate(recipients, single),
+        'bulk': get_rate(recipients, bulk)
+    }
+
+def benchmark_render(recipients=1000):
+    """
+        compare the per recipient cost of rendering each email (get_email_message)
+        against rendering once per discussion (get_email_messages)
+    """
+    from .tasks import get_email_message, get_email_messages
+    contexts = [get_email_context(i) for i in range(recipients)]
+    start = time.perf_counter()
+    for context in contexts:
+        get_email_message(context)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    get_email_messages(contexts)
+    shared = time.perf_counter() - start
+    return {
+        'recipients': recipients,
+        'per_recipient': dict(get_rate(recipients, single), ms=round(single * 1000 / recipients, 4)),
+        'per_discussion': dict(get_rate(recipients, shared), ms=round(shared * 1000 / recipients, 4))
+    }
+
+class BenchmarkRollback(Exception):
+    """
+        raised to roll back the benchmark fixtures
+    """
+
+def create_fixtures(courses, discussions, subscribers, activity=True):
+    """
+        create courses x discussions EolForumNotificationsDiscussions with daily and weekly activity
+        (without activity they are never picked by a notification run) and subscribers users
+        subscribed daily to every discussion, return (course ids, users)
+    """
+    from django.contrib.auth.models import User
+    from opaque_keys.edx.keys import CourseKey, UsageKey
+    from .models import EolForumNotificationsDiscussions, EolForumNotificationsUser
+    course_ids = ['course-v1:{}+c{}+2024'.format(BENCHMARK_PREFIX, i) for i in range(courses)]
+    count = 1 if activity else 0
+    EolForumNotificationsDiscussions.objects.bulk_create([
+        EolForumNotificationsDiscussions(
+            discussion_id='{}-{}'.format(BENCHMARK_PREFIX, j),
+            course_id=CourseKey.from_string(course_id),
+            block_key=UsageKey.from_string('block-v1:{}+c{}+2024+type@discussion+block@d{}'.format(BENCHMARK_PREFIX, i, j)),
+            daily_threads=count,
+            daily_comment=count,
+            weekly_threads=count,
+            weekly_comment=count,
+            daily_pending=activity,
+            weekly_pending=activity) for i, course_id in enumerate(course_ids) for j in range(discussions)])
+    usernames = ['{}_{}'.format(BENCHMARK_PREFIX, i) for i in range(subscribers)]
+    User.objects.bulk_create([User(username=username, email='{}@example.com'.format(username)) for username in usernames])
+    users = list(User.objects.filter(username__in=usernames))
+    for discussion in EolForumNotificationsDiscussions.objects.filter(course_id__in=[CourseKey.from_string(course_id) for course_id in course_ids]):
+        EolForumNotificationsUser.objects.bulk_create([
+            EolForumNotificationsUser(discussion=discussion, user=user, how_often='daily') for user in users])
+    return course_ids, users
+
+def benchmark_pipeline(scales=None):
+    """
+        time send_notification('daily'), get_discussions_users_notifications, get_courses_onlive and the
+        save, get_save and post_save views over synthetic data at several scales
+        (courses, discussions per course, subscribers per discussion).
+        The modulestore, course lookups and email tasks are mocked and the data is rolled back.
+        get_courses_onlive and send_notification only process the synthetic courses, doesn't
+        flush the activity buffer nor enqueue emails and the metrics are discarded
+    """
+    results = []
+    for courses, discussions, subscribers in scales or BENCHMARK_SCALES:
+        try:
+            with transaction.atomic():
+                results.append({
+                    'courses': courses,
+                    'discussions': discussions,
+                    'subscribers': subscribers,
+                    'results': _benchmark_scale(courses, discussions, subscribers)
+                })
+                raise BenchmarkRollback()
+        except BenchmarkRollback:
+            pass
+    return {'scales': results}
+
+def _benchmark_scale(courses, discussions, subscribers):
+    """
+        create the fixtures of one scale and return the timings (seconds and queries) of each function
+    """
+    from django.db.models import Q
+    from django.test import RequestFactory
+    from opaque_keys.edx.keys import CourseKey
+    from .models import EolForumNotificationsDiscussions
+    from .report import NotificationReport
+    from .utils import NOTIFICATIONS_CHUNK_SIZE, get_course_live_filter, get_courses_onlive, get_discussions_users_notifications
+    from .metrics import NullMetrics
+    from .views import save_notification, save_notification_get, save_notification_post, send_notification
+    course = namedtuple('Course', ['display_name_with_default', 'end'])('Benchmark course', None)
+    course_ids, users = create_fixtures(courses, discussions, subscribers)
+    course_keys = [CourseKey.from_string(course_id) for course_id in course_ids]
+    discussion_ids = list(EolForumNotificationsDiscussions.objects.filter(course_id__in=course_keys).values_list('id', flat=True))
+    # the real courses are not read, the timings only depend on the scale
+    fixture_filter = Q(course_id__in=course_keys) & get_course_live_filter()
+    report = NotificationReport()
+    with patch('eol_forum_notifications.utils.get_course_by_id', return_value=course), \
+            patch('eol_forum_notifications.utils.course_image_url', return_value='/assets/image.jpg'), \
+            patch('eol_forum_notifications.views.get_blocks_info', side_effect=_get_blocks_info), \
+            patch('eol_forum_notifications.views.get_info_block_course', return_value={'course_name': 'Benchmark course', 'discussion_name': 'Benchmark discussion'}), \
+            patch('eol_forum_notifications.tasks.task_send_bulk_email.delay'), \
+            patch('eol_forum_notifications.tasks.task_send_bulk_email.apply_async'), \
+            patch('eol_forum_notifications.views.flush_activity'), \
+            patch('eol_forum_notifications.views.refresh_courses_end'), \
+            patch('eol_forum_notifications.views.get_send_deadline', return_value=None), \
+            patch('eol_forum_notifications.metrics.get_metrics', return_value=NullMetrics()), \
+            patch('eol_forum_notifications.report.get_metrics', return_value=NullMetrics()):
+        with patch('eol_forum_notifications.utils.get_course_live_filter', return_value=fixture_filter):
+            with report.phase('get_courses_onlive'):
+                list(get_courses_onlive(how_often='daily', dry_run=True))
+        with report.phase('get_discussions_users_notifications'):
+            list(get_discussions_users_notifications('daily', discussion_ids, NOTIFICATIONS_CHUNK_SIZE))
+        fixture_courses = [(course_id, {'course_name': 'Benchmark course', 'image': '/assets/image.jpg'}) for course_id in course_ids]
+        with patch('eol_forum_notifications.views.get_courses_onlive', return_value=fixture_courses):
+            with report.phase('send_notification'):
+                send_notification('daily')
+        factory = RequestFactory()
+        user = users[0]
+        data = {
+            'discussion_id': '{}-0'.format(BENCHMARK_PREFIX),
+            'course_id': course_ids[0],
+            'user_id': str(user.id),
+            'period': 'weekly'
+        }
+        for name, view, method in [('save', save_notification, 'post'), ('get_save', save_notification_get, 'get'), ('post_save', save_notification_post, 'post')]:
+            request = getattr(factory, method)('/eol_discussion_notification/{}/'.format(name), data)
+            request.user = user
+            with report.phase(name):
+                for i in range(BENCHMARK_VIEW_REQUESTS):
+                    view(request)
+    results = report.as_dict()['phases']
+    for name in ['save', 'get_save', 'post_save']:
+        results[name]['requests'] = BENCHMARK_VIEW_REQUESTS
+    return results
+
+def _get_blocks_info(block_keys, cache=None):
+    """
+        mocked get_blocks_info, every block exists
+    """
+    return {str(block_key): {'display_name': 'Benchmark discussion', 'parent': 'benchmark-parent'} for block_key in block_keys}
+
+def get_percentile(values, percentile):
+    """
+        return the percentile (0-100) of the sorted values
+    """
+    if not values:
+        return None
+    return values[int(round(percentile / 100.0 * (len(values) - 1)))]
+
+def benchmark_save_load(clients=20, requests=50):
+    """
+        post the save view concurrently from clients threads, two threads share each user
+        so the same (discussion, user) is saved concurrently (double clicks).
+        Report latency percentiles and errors, the synthetic data is created without activity,
+        so a concurrent notification run skips it, and deleted at the end
+    """
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+    from django.urls import reverse
+    from opaque_keys.edx.keys import CourseKey
+    from .models import EolForumNotificationsDiscussions
+    url = reverse('eol_discussion_notification:save')
+    course_ids = []
+    users = []
+
+    def run_client(index):
+        """
+            post the save view requests times, return latencies and errors
+        """
+        user = users[index % len(users)]
+        client = Client()
+        client.force_login(user)
+        latencies = []
+        errors = 0
+        try:
+            for i in range(requests):
+                data = {
+                    'discussion_id': '{}-0'.format(BENCHMARK_PREFIX),
+                    'course_id': course_ids[0],
+                    'user_id': str(user.id),
+                    'period': ['daily', 'weekly', 'never'][i % 3]
+                }
+                start = time.perf_counter()
+                try:
+                    response = client.post(url, data)
+                    if response.status_code != 200:
+                        errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+        return latencies, errors
+
+    try:
+        # a failure while creating the fixtures leaves nothing behind
+        with transaction.atomic():
+            course_ids, users = create_fixtures(1, 1, max(1, clients // 2), activity=False)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            results = list(executor.map(run_client, range(clients)))
+        seconds = time.perf_counter() - start
+    finally:
+        EolForumNotificationsDiscussions.objects.filter(course_id__in=[CourseKey.from_string(course_id) for course_id in course_ids]).delete()
+        User.objects.filter(id__in=[user.id for user in users]).delete()
+    latencies = sorted(latency for client_latencies, errors in results for latency in client_latencies)
+    result = {
+        'clients': clients,
+        'requests': len(latencies),
+        'errors': sum(errors for client_latencies, errors in results),
+        'p50_ms': round(get_percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_ms': round(get_percentile(latencies, 99) * 1000, 2) if latencies else None
+    }
+    result.update(get_rate(len(latencies), seconds))
+    return result
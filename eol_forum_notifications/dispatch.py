@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+"""
+    Pace of the notification emails.
+
+    RateLimiter keeps a shared bucket of EOL_FORUM_NOTIFICATIONS_EMAIL_RATE emails per
+    minute in the django cache, every worker takes its tokens from it before sending.
+    DispatchScheduler gives each enqueued chunk a countdown, so a run is spread evenly
+    over EOL_FORUM_NOTIFICATIONS_SEND_DEADLINE seconds without going faster than the rate.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from .metrics import incr, timer
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PREFIX = 'eol_forum_notifications:rate'
+RATE_LIMIT_WINDOW = 60
+
+
+def get_email_rate():
+    """
+        return the emails per minute allowed by the relay, None without limit
+    """
+    return getattr(settings, 'EOL_FORUM_NOTIFICATIONS_EMAIL_RATE', None)
+
+def get_send_deadline():
+    """
+        return the seconds a run has to send its emails, None to send them as soon as possible
+    """
+    return getattr(settings, 'EOL_FORUM_NOTIFICATIONS_SEND_DEADLINE', None)
+
+def get_rate_limiter():
+    """
+        return the shared RateLimiter of the emails, None without EOL_FORUM_NOTIFICATIONS_EMAIL_RATE
+    """
+    rate = get_email_rate()
+    if not rate:
+        return None
+    return RateLimiter(rate)
+
+class RateLimiter(object):
+    """
+        rate tokens per window shared by every worker, the tokens of a window
+        are counted with an atomic cache incr and refilled when the window changes
+    """
+    def __init__(self, rate, window=RATE_LIMIT_WINDOW, key='email'):
+        self.rate = rate
+        self.window = window
+        self.key = key
+
+    def acquire(self, tokens=1):
+        """
+            take tokens, waiting for the next window while the current one is spent,
+            return the seconds waited
+        """
+        waited = 0.0
+        while True:
+            slot = int(time.time() // self.window)
+            key = '{}:{}:{}'.format(RATE_LIMIT_PREFIX, self.key, slot)
+            try:
+                cache.add(key, 0, self.window * 2)
+                count = cache.incr(key, tokens)
+            except ValueError:
+                # key evicted or cache without incr support, don't block the emails
+                logger.info('EolForumNotification - Rate limit cache unavailable, key: {}'.format(key))
+                return waited
+            if count <= self.rate:
+                return waited
+            wait = (slot + 1) * self.window - time.time()
+            if wait > 0:
+                incr('email.throttled')
+                with timer('email.throttle_wait'):
+                    time.sleep(wait)
+                waited += wait
+
+class DispatchScheduler(object):
+    """
+        countdowns of the email chunks of a run, spaced to send total emails evenly in
+        deadline seconds and never faster than rate emails per minute
+    """
+    def __init__(self, rate=None, deadline=None, total=None):
+        self.interval = 0.0
+        if rate:
+            self.interval = 60.0 / rate
+        if deadline and total:
+            self.interval = max(self.interval, float(deadline) / total)
+            if rate and total * 60.0 / rate > deadline:
+                logger.warning('EolForumNotification - {} emails can not be sent in {} seconds at {} emails per minute'.format(total, deadline, rate))
+        self.start = time.monotonic()
+        self.cursor = 0.0
+
+    def countdown(self, count):
+        """
+            return the countdown of the next chunk of count emails and reserve its time
+        """
+        countdown = max(0.0, self.start + self.cursor - time.monotonic())
+        self.cursor += count * self.interval
+        return countdown
@@ -3,14 +3,28 @@ from django.core.management.base import BaseCommand, CommandError
 from opaque_keys.edx.keys import CourseKey
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.db import connections
 from eol_forum_notifications.views import send_notification
 
 import datetime
 from django.utils import timezone
 
+import cProfile
+import json
 import logging
+import multiprocessing
 logger = logging.getLogger(__name__)
 
+def send_notification_shard(how_often, shards, shard_index, dry_run=False):
+    """
+        run send_notification for one shard in a worker process, return the report as dict
+    """
+    try:
+        report = send_notification(how_often, shards=shards, shard_index=shard_index, dry_run=dry_run)
+    finally:
+        connections.close_all()
+    return report.as_dict()
+
 class Command(BaseCommand):
     help = 'This command will send notification emails.'
 
@@ -20,10 +34,82 @@ class Command(BaseCommand):
             help='period when notification will be sent',
             default=None
         )
+        parser.add_argument(
+            '--digest',
+            action='store_true',
+            help='send a single email to each user with all his discussions'
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=1,
+            help='number of shards the courses are split in'
+        )
+        parser.add_argument(
+            '--shard-index',
+            type=int,
+            default=None,
+            help='shard processed by this run, from 0 to shards - 1, required with shards unless workers is used'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='process all shards in a local pool of workers'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='run without enqueuing emails nor resetting counters and print the run report'
+        )
+        parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='discussion_notification.prof',
+            default=None,
+            help='print the run report and dump a cProfile file (default discussion_notification.prof)'
+        )
 
     def handle(self, *args, **options):
         logger.info('EolForumNoticationsCommand - Running send_notification()')
         if options['how_often'] not in ['weekly', 'daily']:
             raise CommandError("EolForumNoticationsCommand - how_often must be 'weekly' or 'daily'")
         how_often = options['how_often']
-        send_notification(how_often)
+        shards = options['shards']
+        shard_index = options['shard_index']
+        workers = options['workers']
+        if shards < 1 or (workers is not None and workers < 1):
+            raise CommandError("EolForumNoticationsCommand - shards and workers must be greater than 0")
+        if options['digest'] and (shards > 1 or workers is not None):
+            raise CommandError("EolForumNoticationsCommand - digest can not be sharded, users would get one email per shard")
+        if options['profile'] and workers is not None:
+            raise CommandError("EolForumNoticationsCommand - profile can not be used with workers")
+        if workers is not None:
+            if shard_index is not None:
+                raise CommandError("EolForumNoticationsCommand - shard-index can not be used with workers")
+            shards = max(shards, workers)
+            logger.info('EolForumNoticationsCommand - Running {} shards with {} workers'.format(shards, workers))
+            # forked workers must open their own database connections
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                reports = pool.starmap(send_notification_shard, [(how_often, shards, i, options['dry_run']) for i in range(shards)])
+            if options['dry_run']:
+                self.stdout.write(json.dumps(reports, indent=2))
+            return
+        if shard_index is None:
+            if shards > 1:
+                raise CommandError("EolForumNoticationsCommand - shard-index is required with shards, or use workers")
+            shard_index = 0
+        if not 0 <= shard_index < shards:
+            raise CommandError("EolForumNoticationsCommand - shard-index must be between 0 and shards - 1")
+        profiler = None
+        if options['profile']:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        report = send_notification(how_often, digest=options['digest'], shards=shards, shard_index=shard_index, dry_run=options['dry_run'])
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options['profile'])
+            self.stdout.write('cProfile stats saved in {}'.format(options['profile']))
+        if options['dry_run'] or profiler is not None:
+            self.stdout.write(report.format())
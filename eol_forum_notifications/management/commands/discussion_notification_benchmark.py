@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from eol_forum_notifications import benchmark
+
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'This command will run the notification benchmarks and print the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenario',
+            choices=['email', 'render', 'pipeline', 'save_load'],
+            help='benchmark to run'
+        )
+        parser.add_argument(
+            '--recipients',
+            type=int,
+            default=1000,
+            help='number of synthetic recipients'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=50,
+            help='recipients per bulk email task'
+        )
+        parser.add_argument(
+            '--clients',
+            type=int,
+            default=20,
+            help='concurrent clients of the save_load benchmark'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=50,
+            help='requests per client of the save_load benchmark'
+        )
+        parser.add_argument(
+            '--scales',
+            default=None,
+            help='pipeline scales as comma separated COURSESxDISCUSSIONSxSUBSCRIBERS, e.g. 1x10x10,5x20x50'
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='also write the JSON result to this file'
+        )
+
+    def handle(self, *args, **options):
+        logger.info('EolForumNoticationsBenchmark - Running {} benchmark'.format(options['scenario']))
+        if options['scenario'] == 'email':
+            result = benchmark.benchmark_email(options['recipients'], options['chunk_size'])
+        elif options['scenario'] == 'render':
+            result = benchmark.benchmark_render(options['recipients'])
+        elif options['scenario'] == 'save_load':
+            if options['clients'] < 1 or options['requests'] < 1:
+                raise CommandError('EolForumNoticationsBenchmark - clients and requests must be greater than 0')
+            result = benchmark.benchmark_save_load(options['clients'], options['requests'])
+        else:
+            scales = None
+            if options['scales']:
+                try:
+                    scales = [tuple(int(value) for value in scale.split('x')) for scale in options['scales'].split(',')]
+                except ValueError:
+                    raise CommandError('EolForumNoticationsBenchmark - scales must be COURSESxDISCUSSIONSxSUBSCRIBERS')
+                if any(len(scale) != 3 for scale in scales):
+                    raise CommandError('EolForumNoticationsBenchmark - scales must be COURSESxDISCUSSIONSxSUBSCRIBERS')
+            result = benchmark.benchmark_pipeline(scales)
+        output = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from eol_forum_notifications import purge
+from eol_forum_notifications.utils import NOTIFICATIONS_RESUME_HOURS, refresh_courses_end
+
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'This command will delete the notification models of courses ended long ago and the old notification runs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=None,
+            help='purge courses ended more than days ago (default EOL_FORUM_NOTIFICATIONS_PURGE_DAYS)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=purge.PURGE_BATCH_SIZE,
+            help='rows read and deleted by each query'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=purge.PURGE_SLEEP,
+            help='seconds to wait between batches'
+        )
+        parser.add_argument(
+            '--archive',
+            default=None,
+            help='append the deleted rows to this file as JSON lines'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='only count the rows to purge, courses without saved end date are not counted'
+        )
+
+    def handle(self, *args, **options):
+        logger.info('EolForumNoticationsPurge - Running purge_ended_courses()')
+        days = options['days']
+        if days is None:
+            days = getattr(settings, 'EOL_FORUM_NOTIFICATIONS_PURGE_DAYS', purge.PURGE_DAYS)
+        if days < 0 or options['batch_size'] < 1 or options['sleep'] < 0:
+            raise CommandError('EolForumNoticationsPurge - days and sleep must not be negative and batch-size must be greater than 0')
+        if not options['dry_run']:
+            courses = purge.fill_courses_end(options['batch_size'], options['sleep'])
+            logger.info('EolForumNoticationsPurge - course end saved, courses: {}'.format(courses))
+            courses = refresh_courses_end(options['batch_size'])
+            logger.info('EolForumNoticationsPurge - course end refreshed, courses: {}'.format(courses))
+        archive = open(options['archive'], 'a') if options['archive'] and not options['dry_run'] else None
+        try:
+            result = purge.purge_ended_courses(days, options['batch_size'], options['sleep'], archive, options['dry_run'])
+        finally:
+            if archive is not None:
+                archive.close()
+        hours = getattr(settings, 'EOL_FORUM_NOTIFICATIONS_RESUME_HOURS', NOTIFICATIONS_RESUME_HOURS)
+        result['runs'] = purge.purge_notification_runs(hours, options['batch_size'], options['sleep'], options['dry_run'])
+        self.stdout.write(json.dumps(result))
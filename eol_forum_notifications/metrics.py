@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+"""
+    Timings and counters of the notification hot paths.
+
+    The backend is configured with EOL_FORUM_NOTIFICATIONS_METRICS, e.g.
+    {'BACKEND': 'eol_forum_notifications.metrics.StatsdMetrics',
+     'OPTIONS': {'host': 'localhost', 'port': 8125, 'prefix': 'eol_forum_notifications'}},
+    without it metrics are discarded.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from django.conf import settings
+from django.utils.module_loading import import_string
+import logging
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_BACKEND = 'eol_forum_notifications.metrics.NullMetrics'
+
+
+class NullMetrics(object):
+    """
+        discard every metric
+    """
+    def timing(self, name, seconds):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+class MemoryMetrics(NullMetrics):
+    """
+        keep the metrics in memory, used by tests
+    """
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def timing(self, name, seconds):
+        self.timings[name].append(seconds)
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def clear(self):
+        self.timings.clear()
+        self.counters.clear()
+
+class StatsdMetrics(NullMetrics):
+    """
+        send the metrics to a statsd server over UDP, errors are only logged
+    """
+    def __init__(self, host='localhost', port=8125, prefix='eol_forum_notifications'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds):
+        self._send('{}:{}|ms'.format(name, int(round(seconds * 1000))))
+
+    def incr(self, name, value=1):
+        self._send('{}:{}|c'.format(name, value))
+
+    def _send(self, data):
+        if self.prefix:
+            data = '{}.{}'.format(self.prefix, data)
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except Exception as e:
+            logger.info('EolForumNotification - Error to send metric, error: {}'.format(str(e)))
+
+_backend = {'config': None, 'metrics': None}
+
+def get_metrics():
+    """
+        return the configured metrics backend, built again when the setting changes
+    """
+    config = getattr(settings, 'EOL_FORUM_NOTIFICATIONS_METRICS', None) or {}
+    if _backend['metrics'] is None or _backend['config'] != config:
+        try:
+            metrics = import_string(config.get('BACKEND', METRICS_BACKEND))(**config.get('OPTIONS', {}))
+        except Exception as e:
+            logger.error('EolForumNotification - Error to load metrics backend, error: {}'.format(str(e)))
+            metrics = NullMetrics()
+        _backend['config'] = config
+        _backend['metrics'] = metrics
+    return _backend['metrics']
+
+def incr(name, value=1):
+    """
+        increment counter name
+    """
+    get_metrics().incr(name, value)
+
+@contextmanager
+def timer(name):
+    """
+        send the wall time of the block as timing name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_metrics().timing(name, time.perf_counter() - start)
+
+def timed(name):
+    """
+        view decorator sending its wall time and a counter per response status
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with timer(name):
+                response = view(request, *args, **kwargs)
+            incr('{}.{}'.format(name, response.status_code))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eol_forum_notifications', '0005_eolforumnotificationsdiscussions_block_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('how_often', models.CharField(choices=[('daily', 'daily'), ('weekly', 'weekly')], max_length=10)),
+                ('digest', models.BooleanField(default=False)),
+                ('shards', models.IntegerField(default=1)),
+                ('shard_index', models.IntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(default=None, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NotificationRunDiscussion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('discussion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='eol_forum_notifications.EolForumNotificationsDiscussions')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='eol_forum_notifications.NotificationRun')),
+            ],
+            options={
+                'unique_together': {('run', 'discussion')},
+            },
+        ),
+    ]
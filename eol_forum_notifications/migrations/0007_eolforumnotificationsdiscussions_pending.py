@@ -0,0 +1,31 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def set_pending(apps, schema_editor):
+    EolForumNotificationsDiscussions = apps.get_model('eol_forum_notifications', 'EolForumNotificationsDiscussions')
+    EolForumNotificationsDiscussions.objects.filter(Q(daily_threads__gt=0) | Q(daily_comment__gt=0)).update(daily_pending=True)
+    EolForumNotificationsDiscussions.objects.filter(Q(weekly_threads__gt=0) | Q(weekly_comment__gt=0)).update(weekly_pending=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eol_forum_notifications', '0006_notificationrun_notificationrundiscussion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eolforumnotificationsdiscussions',
+            name='daily_pending',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='eolforumnotificationsdiscussions',
+            name='weekly_pending',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(set_pending, migrations.RunPython.noop),
+    ]
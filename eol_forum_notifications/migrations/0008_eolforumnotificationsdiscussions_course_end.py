@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eol_forum_notifications', '0007_eolforumnotificationsdiscussions_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eolforumnotificationsdiscussions',
+            name='course_end',
+            field=models.DateTimeField(db_index=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import eol_forum_notifications.models
+
+HOW_OFTEN_VALUES = {'never': 0, 'daily': 1, 'weekly': 2}
+
+
+def encode_how_often(apps, schema_editor):
+    EolForumNotificationsUser = apps.get_model('eol_forum_notifications', 'EolForumNotificationsUser')
+    for name, value in HOW_OFTEN_VALUES.items():
+        EolForumNotificationsUser.objects.filter(how_often=name).update(how_often_code=value)
+
+
+def decode_how_often(apps, schema_editor):
+    EolForumNotificationsUser = apps.get_model('eol_forum_notifications', 'EolForumNotificationsUser')
+    for name, value in HOW_OFTEN_VALUES.items():
+        EolForumNotificationsUser.objects.filter(how_often_code=value).update(how_often=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eol_forum_notifications', '0008_eolforumnotificationsdiscussions_course_end'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eolforumnotificationsuser',
+            name='how_often_code',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(encode_how_often, decode_how_often),
+        migrations.RemoveField(
+            model_name='eolforumnotificationsuser',
+            name='how_often',
+        ),
+        migrations.RenameField(
+            model_name='eolforumnotificationsuser',
+            old_name='how_often_code',
+            new_name='how_often',
+        ),
+        migrations.AlterField(
+            model_name='eolforumnotificationsuser',
+            name='how_often',
+            field=eol_forum_notifications.models.HowOftenField(choices=[('never', 'never'), ('daily', 'daily'), ('weekly', 'weekly')], default='never'),
+        ),
+        migrations.AddIndex(
+            model_name='eolforumnotificationsuser',
+            index=models.Index(fields=['discussion', 'how_often', 'id', 'user'], name='eol_forum_notif_keyset_idx'),
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils.functional import cached_property
 import datetime
 from opaque_keys.edx.django.models import CourseKeyField, UsageKeyField
 
@@ -21,10 +23,59 @@ class EolForumNotificationsDiscussions(models.Model):
     daily_comment = models.IntegerField(default=0)
     weekly_threads = models.IntegerField(default=0)
     weekly_comment = models.IntegerField(default=0)
+    # set when the period has threads and/or comments to notify, so runs only select dirty discussions
+    daily_pending = models.BooleanField(default=False, db_index=True)
+    weekly_pending = models.BooleanField(default=False, db_index=True)
+    # end date of the course from CourseOverview, saved when an ended course is loaded, refreshed
+    # by every run for the ended courses and filled by the purge, None if unknown
+    course_end = models.DateTimeField(default=None, null=True, db_index=True)
 
     def __str__(self):
         return '%s - %s' % (self.discussion_id, self.course_id)
 
+    def save(self, *args, **kwargs):
+        """
+            keep the pending flags in sync with the counters (unless they are expressions)
+        """
+        counters = (self.daily_threads, self.daily_comment, self.weekly_threads, self.weekly_comment)
+        if all(isinstance(counter, int) for counter in counters):
+            self.daily_pending = self.daily_threads > 0 or self.daily_comment > 0
+            self.weekly_pending = self.weekly_threads > 0 or self.weekly_comment > 0
+        super(EolForumNotificationsDiscussions, self).save(*args, **kwargs)
+
+# how_often values stored by HowOftenField
+HOW_OFTEN_VALUES = {'never': 0, 'daily': 1, 'weekly': 2}
+HOW_OFTEN_NAMES = {value: name for name, value in HOW_OFTEN_VALUES.items()}
+
+class HowOftenField(models.PositiveSmallIntegerField):
+    """
+        how_often stored as a small integer, python code, lookups and forms use the names (never, daily, weekly)
+    """
+    description = 'Notification period stored as a small integer'
+
+    @cached_property
+    def validators(self):
+        # the python value is a name, integer range validators don't apply
+        return [*self.default_validators, *self._validators]
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return HOW_OFTEN_NAMES[value]
+
+    def to_python(self, value):
+        if value is None or value in HOW_OFTEN_VALUES:
+            return value
+        try:
+            return HOW_OFTEN_NAMES[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice', params={'value': value})
+
+    def get_prep_value(self, value):
+        if isinstance(value, str) and value in HOW_OFTEN_VALUES:
+            value = HOW_OFTEN_VALUES[value]
+        return super(HowOftenField, self).get_prep_value(value)
+
 class EolForumNotificationsUser(models.Model):
     HOW_OFTEN_CHOICES = (("never", "never"), ("daily", "daily"), ("weekly", "weekly") )
     class Meta:
@@ -34,7 +85,38 @@ class EolForumNotificationsUser(models.Model):
         unique_together = [
             ["discussion", "user"],
         ]
+        indexes = [
+            # subscribers of a discussion in a period, paginated by id, are read from the index alone
+            models.Index(fields=['discussion', 'how_often', 'id', 'user'], name='eol_forum_notif_keyset_idx'),
+        ]
     
     user = models.ForeignKey(User, db_index=True, on_delete=models.CASCADE)
     discussion = models.ForeignKey(EolForumNotificationsDiscussions, db_index=True, on_delete=models.CASCADE)
-    how_often = models.TextField(choices=HOW_OFTEN_CHOICES, default='never')
\ No newline at end of file
+    how_often = HowOftenField(choices=HOW_OFTEN_CHOICES, default='never')
+
+class NotificationRun(models.Model):
+    """
+        A send_notification run, unfinished runs are resumed by the next run with the same parameters
+    """
+    HOW_OFTEN_CHOICES = (("daily", "daily"), ("weekly", "weekly") )
+    how_often = models.CharField(choices=HOW_OFTEN_CHOICES, max_length=10)
+    digest = models.BooleanField(default=False)
+    shards = models.IntegerField(default=1)
+    shard_index = models.IntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, default=None)
+
+    def __str__(self):
+        return '%s - %s (%s/%s)' % (self.id, self.how_often, self.shard_index, self.shards)
+
+class NotificationRunDiscussion(models.Model):
+    """
+        Discussions already notified (emails enqueued and counters reset) by a run
+    """
+    class Meta:
+        unique_together = [
+            ["run", "discussion"],
+        ]
+
+    run = models.ForeignKey(NotificationRun, on_delete=models.CASCADE)
+    discussion = models.ForeignKey(EolForumNotificationsDiscussions, on_delete=models.CASCADE)
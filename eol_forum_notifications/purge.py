@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+"""
+    Purge of the notification models of ended courses, run with the
+    discussion_notification_purge command. Rows are read and deleted in small
+    keyset batches with a pause between them, so it can run on the live database
+"""
+from django.utils.timezone import now
+from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
+from .models import EolForumNotificationsDiscussions, EolForumNotificationsUser, NotificationRun, NotificationRunDiscussion
+from .utils import NOTIFICATIONS_RESUME_HOURS, delete_run_ledger, update_course_end
+from datetime import timedelta
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+PURGE_DAYS = 365
+PURGE_BATCH_SIZE = 500
+PURGE_SLEEP = 0.5
+
+
+def fill_courses_end(batch_size=PURGE_BATCH_SIZE, sleep=PURGE_SLEEP):
+    """
+        save the CourseOverview end date in the discussions without course_end,
+        return the number of courses updated
+    """
+    updated = 0
+    last_course = None
+    while True:
+        courses = EolForumNotificationsDiscussions.objects.filter(course_end__isnull=True)
+        if last_course is not None:
+            courses = courses.filter(course_id__gt=last_course)
+        courses = list(courses.values_list('course_id', flat=True).distinct().order_by('course_id')[:batch_size])
+        for course_key, end in CourseOverview.objects.filter(id__in=courses, end__isnull=False).values_list('id', 'end'):
+            update_course_end(course_key, end)
+            updated += 1
+        if len(courses) < batch_size:
+            return updated
+        last_course = courses[-1]
+        time.sleep(sleep)
+
+def purge_ended_courses(days=PURGE_DAYS, batch_size=PURGE_BATCH_SIZE, sleep=PURGE_SLEEP, archive=None, dry_run=False):
+    """
+        delete discussions and user notifications of the courses ended more than days ago,
+        archive is an open file where the deleted rows are written as JSON lines.
+        With dry_run the rows are only counted. Return the number of rows by model
+    """
+    limit = now() - timedelta(days=days)
+    result = {'discussions': 0, 'users': 0}
+    last_id = 0
+    while True:
+        discussions = list(EolForumNotificationsDiscussions.objects.filter(
+            course_end__lt=limit,
+            id__gt=last_id).order_by('id').values(
+                'id',
+                'discussion_id',
+                'course_id',
+                'block_key',
+                'course_end'
+            )[:batch_size])
+        if not discussions:
+            return result
+        ids = [discussion['id'] for discussion in discussions]
+        result['users'] += _purge_users(ids, batch_size, sleep, archive, dry_run)
+        if not dry_run:
+            _write_archive(archive, 'discussion', discussions)
+            NotificationRunDiscussion.objects.filter(discussion_id__in=ids).delete()
+            EolForumNotificationsDiscussions.objects.filter(id__in=ids).delete()
+            time.sleep(sleep)
+        result['discussions'] += len(ids)
+        logger.info('EolForumNotification - Purge, discussions: {}, users: {}, dry_run: {}'.format(result['discussions'], result['users'], dry_run))
+        last_id = ids[-1]
+
+def purge_notification_runs(hours=NOTIFICATIONS_RESUME_HOURS, batch_size=PURGE_BATCH_SIZE, sleep=PURGE_SLEEP, dry_run=False):
+    """
+        delete the runs started more than hours ago, finished or abandoned (they are not resumed anymore),
+        and their ledger. With dry_run the runs are only counted. Return the number of runs
+    """
+    runs = NotificationRun.objects.filter(started_at__lt=now() - timedelta(hours=hours))
+    if dry_run:
+        return runs.count()
+    count = 0
+    last_id = 0
+    while True:
+        ids = list(runs.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return count
+        for run_id in ids:
+            delete_run_ledger(run_id, batch_size)
+        NotificationRun.objects.filter(id__in=ids).delete()
+        count += len(ids)
+        logger.info('EolForumNotification - Purge, runs: {}'.format(count))
+        last_id = ids[-1]
+        time.sleep(sleep)
+
+def _purge_users(discussion_ids, batch_size, sleep, archive, dry_run):
+    """
+        delete the user notifications of the discussions in batches, return the number of rows
+    """
+    if dry_run:
+        return EolForumNotificationsUser.objects.filter(discussion_id__in=discussion_ids).count()
+    count = 0
+    last_id = 0
+    while True:
+        users = list(EolForumNotificationsUser.objects.filter(
+            discussion_id__in=discussion_ids,
+            id__gt=last_id).order_by('id').values('id', 'discussion_id', 'user_id', 'how_often')[:batch_size])
+        if not users:
+            return count
+        _write_archive(archive, 'user', users)
+        EolForumNotificationsUser.objects.filter(id__in=[user['id'] for user in users]).delete()
+        count += len(users)
+        last_id = users[-1]['id']
+        time.sleep(sleep)
+
+def _write_archive(archive, model, rows):
+    """
+        write rows to the archive file as JSON lines
+    """
+    if archive is None:
+        return
+    for row in rows:
+        archive.write(json.dumps({'model': model, 'fields': row}, default=str) + '\n')
+    archive.flush()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+"""
+    Counters and phase timings of a notification run
+"""
+from contextlib import contextmanager
+from django.db import connection
+from .metrics import get_metrics
+import time
+
+
+class QueryCounter(object):
+    """
+        django execute wrapper counting the queries
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+class NotificationReport(object):
+    """
+        Courses, discussions and recipients processed by send_notification
+        and wall time and queries spent in each phase
+    """
+    def __init__(self):
+        self.counters = {
+            'courses': 0,
+            'discussions': 0,
+            'recipients': 0,
+            'emails_enqueued': 0
+        }
+        self.phases = {}
+
+    def incr(self, name, value=1):
+        """
+            increment counter name
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name):
+        """
+            add wall time and queries of the block to phase name
+        """
+        counter = QueryCounter()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                yield
+        finally:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'queries': 0})
+            phase['seconds'] += time.perf_counter() - start
+            phase['queries'] += counter.count
+
+    def iterate(self, name, iterable):
+        """
+            yield the items of iterable adding the time spent producing them to phase name
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def as_dict(self):
+        """
+            return counters and phases
+        """
+        return {
+            'counters': dict(self.counters),
+            'phases': {name: {'seconds': round(phase['seconds'], 4), 'queries': phase['queries']} for name, phase in self.phases.items()}
+        }
+
+    def send_metrics(self, prefix):
+        """
+            send the counters and the wall time of each phase to the metrics backend
+        """
+        metrics = get_metrics()
+        for name, value in self.counters.items():
+            metrics.incr('{}.{}'.format(prefix, name), value)
+        for name, phase in self.phases.items():
+            metrics.timing('{}.{}'.format(prefix, name), phase['seconds'])
+            metrics.incr('{}.{}.queries'.format(prefix, name), phase['queries'])
+
+    def format(self):
+        """
+            return a human readable breakdown
+        """
+        lines = ['{}: {}'.format(name, value) for name, value in self.counters.items()]
+        lines.append('{:<40} {:>12} {:>10}'.format('phase', 'seconds', 'queries'))
+        for name, phase in self.phases.items():
+            lines.append('{:<40} {:>12.4f} {:>10}'.format(name, phase['seconds'], phase['queries']))
+        return '\n'.join(lines)
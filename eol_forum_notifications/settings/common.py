@@ -1,2 +1,10 @@
 def plugin_settings(settings):
-    settings.EOL_FORUMS_NOTIFICATIONS_ENABLE = True
\ No newline at end of file
+    settings.EOL_FORUMS_NOTIFICATIONS_ENABLE = True
+    settings.EOL_FORUM_NOTIFICATIONS_EMAIL_CHUNK_SIZE = 50
+    settings.EOL_FORUM_NOTIFICATIONS_ACTIVITY_FLUSH_EVERY = 100
+    settings.EOL_FORUM_NOTIFICATIONS_CHUNK_SIZE = 500
+    settings.EOL_FORUM_NOTIFICATIONS_RESUME_HOURS = 12
+    settings.EOL_FORUM_NOTIFICATIONS_BLOCK_COURSE_TIMEOUT = 60 * 60
+    settings.EOL_FORUM_NOTIFICATIONS_PURGE_DAYS = 365
+    settings.EOL_FORUM_NOTIFICATIONS_EMAIL_RATE = None
+    settings.EOL_FORUM_NOTIFICATIONS_SEND_DEADLINE = None
\ No newline at end of file
@@ -3,39 +3,179 @@ from openedx.core.djangoapps.site_configuration import helpers as configuration_
 from django.conf import settings
 
 from celery import task
-from django.core.mail import send_mail
-from django.utils.html import strip_tags
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection, send_mail
+from django.utils.html import escape
 from django.contrib.auth.models import User
 from opaque_keys.edx.keys import CourseKey, UsageKey
 from opaque_keys import InvalidKeyError
-from django.template.loader import render_to_string
+from django.template.loader import get_template
+from .activity import flush_activity
+from .dispatch import get_rate_limiter
+from .metrics import incr, timer
 from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions
 from django.utils.timezone import now
 from datetime import timedelta
 import logging
+import re
 logger = logging.getLogger(__name__)
 
 EMAIL_DEFAULT_RETRY_DELAY = 30
 EMAIL_MAX_RETRIES = 5
+EMAIL_CHUNK_SIZE = 50
+EMAIL_IDEMPOTENCY_TIMEOUT = 7 * 24 * 60 * 60
+# Recipient fields replaced after rendering the shared email of a discussion
+EMAIL_RECIPIENT_FIELDS = ('user_id', 'email', 'notif_url')
+EMAIL_PLACEHOLDER = '@@EOL_FORUM_NOTIFICATIONS_{}@@'
+EMAIL_PLACEHOLDER_RE = re.compile(r'@@EOL_FORUM_NOTIFICATIONS_(\w+)@@')
+# Compiled email templates, loaded once per process
+EMAIL_TEMPLATES = {}
+
+def get_email_chunk_size():
+    """
+        return how many recipients are sent by each task_send_bulk_email
+    """
+    return getattr(settings, 'EOL_FORUM_NOTIFICATIONS_EMAIL_CHUNK_SIZE', EMAIL_CHUNK_SIZE)
+
+def get_email_template(name):
+    """
+        return the compiled template eol_forum_notifications/name, loaded once per process
+    """
+    if name not in EMAIL_TEMPLATES:
+        EMAIL_TEMPLATES[name] = get_template('eol_forum_notifications/{}'.format(name))
+    return EMAIL_TEMPLATES[name]
+
+def get_email_message(context):
+    """
+        return subject, plain and html message of the notification email,
+        digest context (with discussions list) uses the digest templates
+    """
+    subject = 'Nueva actividad en el foro de {}'.format(context['platform_name'])
+    name = 'email_digest' if 'discussions' in context else 'email'
+    html_message = get_email_template('{}.html'.format(name)).render(context)
+    plain_message = get_email_template('{}.txt'.format(name)).render(context)
+    return subject, plain_message, html_message
+
+def get_sent_key(context):
+    """
+        return cache key marking the email of context as sent, None without idempotency_key
+    """
+    if context.get('idempotency_key') is None:
+        return None
+    return 'eol_forum_notifications:sent:{}'.format(context['idempotency_key'])
+
+def get_email_messages(contexts):
+    """
+        return subject, plain and html message of every context. Emails of the same
+        discussion and period are rendered once and only the recipient fields are replaced
+    """
+    rendered = {}
+    messages = []
+    for context in contexts:
+        if 'discussions' in context:
+            messages.append(get_email_message(context))
+            continue
+        key = (context['course_id'], context['discussion_id'], context['how_often'])
+        if key not in rendered:
+            shared_context = dict(context)
+            for field in EMAIL_RECIPIENT_FIELDS:
+                shared_context[field] = EMAIL_PLACEHOLDER.format(field)
+            rendered[key] = get_email_message(shared_context)
+        subject, plain_message, html_message = rendered[key]
+        # the plain template doesn't escape, the html one does
+        plain_message = EMAIL_PLACEHOLDER_RE.sub(lambda m: str(context[m.group(1)]), plain_message)
+        html_message = EMAIL_PLACEHOLDER_RE.sub(lambda m: escape(context[m.group(1)]), html_message)
+        messages.append((subject, plain_message, html_message))
+    return messages
 
 @task(
     queue='edx.lms.core.low',
     default_retry_delay=EMAIL_DEFAULT_RETRY_DELAY,
     max_retries=EMAIL_MAX_RETRIES)
 def task_send_single_email(discussion_id, course_id, context):
-    subject = 'Nueva actividad en el foro de {}'.format(context['platform_name'])
+    with timer('email.render'):
+        subject, plain_message, html_message = get_email_message(context)
     emails = [context['email']]
-    html_message = render_to_string('eol_forum_notifications/email.html', context)
-    plain_message = strip_tags(html_message)
     from_email = configuration_helpers.get_value(
         'email_from_address',
         settings.BULK_EMAIL_DEFAULT_FROM_EMAIL
     )
-    mail = send_mail(
-        subject,
-        plain_message,
-        from_email,
-        emails,
-        fail_silently=False,
-        html_message=html_message)
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limiter.acquire()
+    with timer('email.smtp'):
+        mail = send_mail(
+            subject,
+            plain_message,
+            from_email,
+            emails,
+            fail_silently=False,
+            html_message=html_message)
+    incr('email.sent', mail)
     return mail
+
+@task(
+    bind=True,
+    queue='edx.lms.core.low',
+    default_retry_delay=EMAIL_DEFAULT_RETRY_DELAY,
+    max_retries=EMAIL_MAX_RETRIES)
+def task_send_bulk_email(self, contexts):
+    """
+        Send the notification emails of a chunk of recipients over one connection,
+        only the failed recipients are retried. Recipients with an idempotency_key
+        already sent (e.g. redelivered or resumed tasks) are skipped.
+        Each email takes a token of the shared rate limiter (see dispatch.py)
+    """
+    from_email = configuration_helpers.get_value(
+        'email_from_address',
+        settings.BULK_EMAIL_DEFAULT_FROM_EMAIL
+    )
+    messages = []
+    with timer('email.render'):
+        rendered = get_email_messages(contexts)
+    for context, (subject, plain_message, html_message) in zip(contexts, rendered):
+        message = EmailMultiAlternatives(subject, plain_message, from_email, [context['email']])
+        message.attach_alternative(html_message, 'text/html')
+        messages.append((context, message))
+    failed = []
+    limiter = get_rate_limiter()
+    connection = get_connection(fail_silently=False)
+    try:
+        with timer('email.smtp_connect'):
+            connection.open()
+        for context, message in messages:
+            message.connection = connection
+            sent_key = get_sent_key(context)
+            if sent_key is not None and not cache.add(sent_key, True, EMAIL_IDEMPOTENCY_TIMEOUT):
+                logger.info('EolForumNotification - Email already sent, user: {}, key: {}'.format(context['user_id'], context['idempotency_key']))
+                incr('email.skipped')
+                continue
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                with timer('email.smtp'):
+                    connection.send_messages([message])
+                incr('email.sent')
+            except Exception as e:
+                logger.info('EolForumNotification - Error to send email, user: {}, error: {}'.format(context['user_id'], str(e)))
+                if sent_key is not None:
+                    cache.delete(sent_key)
+                failed.append(context)
+    except Exception as e:
+        logger.error('EolForumNotification - Error to open email connection, error: {}'.format(str(e)))
+        failed = [context for context, message in messages]
+    finally:
+        connection.close()
+    if failed:
+        incr('email.failed', len(failed))
+        logger.info('EolForumNotification - Retry emails, failed: {}, sent: {}'.format(len(failed), len(messages) - len(failed)))
+        raise self.retry(args=[failed])
+    return len(messages)
+
+@task(queue='edx.lms.core.low')
+def task_flush_activity():
+    """
+        write the forum activity buffered in the cache to the database,
+        enqueued by record_activity so the flush does not run in the request
+    """
+    return flush_activity()
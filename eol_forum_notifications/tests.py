@@ -1,30 +1,50 @@
 # -*- coding: utf-8 -*-
 # Python Standard Libraries
 from collections import namedtuple
+from datetime import timedelta
 from io import StringIO
 import json
+import os
+import tempfile
+import tracemalloc
 
 # Installed packages (via pip)
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import F
 from django.http import HttpRequest, HttpResponse
 from django.test import Client, TestCase
-from django.test.utils import override_settings
+from unittest import skipUnless
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from django.utils.timezone import now
 from mock import patch, MagicMock
 
 # Edx dependencies
 from common.djangoapps.student.roles import CourseStaffRole
 from common.djangoapps.student.tests.factories import UserFactory, CourseEnrollmentFactory
 from common.djangoapps.util.testing import UrlResetMixin
-from opaque_keys.edx.keys import UsageKey
+from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
+from openedx.core.djangoapps.content.course_overviews.tests.factories import CourseOverviewFactory
+from opaque_keys.edx.keys import CourseKey, UsageKey
 from xmodule.modulestore.tests.django_utils import ModuleStoreTestCase
 from xmodule.modulestore.tests.factories import CourseFactory
 
 # Internal project dependencies
-from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions
-from .utils import get_user_data, get_info_block_course, get_block_info
+from . import benchmark
+from .activity import ACTIVITY_PREFIX, record_activity, flush_activity
+from .dispatch import DispatchScheduler, RateLimiter
+from .metrics import MemoryMetrics, StatsdMetrics, get_metrics
+from .report import NotificationReport
+from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions, NotificationRun, NotificationRunDiscussion
+from .utils import get_course_live_filter, get_user_data, invalidate_user_discussions, get_users_data, upsert_user_notification, get_info_block_course, get_block_info, get_blocks_info, get_discussions_users_notifications, get_courses_onlive, reset_discussions_counters, get_discussions_onlive, get_course_shard, get_courses_metadata, get_notification_run, refresh_courses_end
+from .tasks import get_email_message, get_email_messages, get_email_template, task_flush_activity, task_send_bulk_email
+from .management.commands.discussion_notification import send_notification_shard
 from .views import send_notification, save_notification, save_notification_get, save_notification_post
 
 class TestRequest(object):
@@ -38,10 +58,17 @@ class TestRequest(object):
     params = None
     headers = None
 
+def blocks_info_mock(block_info):
+    """
+    Return a get_blocks_info side effect with the same block info for every block
+    """
+    return lambda block_keys, cache=None: {str(block_key): block_info for block_key in block_keys}
+
 class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
 
     def setUp(self):
         super(TestNotifiactionsDiscussion, self).setUp()
+        cache.clear()
         self.course = CourseFactory.create(org='foo', course='baz', run='bar')
         self.block_key = UsageKey.from_string('block-v1:eol+test100+2021_1+type@eoldiscussion+block@5c13942678184cab9a5345b660292c6e')
         self.discussion = EolForumNotificationsDiscussions.objects.create(
@@ -237,7 +264,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
 
     @override_settings(PLATFORM_NAME='Test')
     @override_settings(LMS_ROOT_URL='https://test.ts')
-    @patch('eol_forum_notifications.views.get_block_info')
+    @patch('eol_forum_notifications.views.get_blocks_info')
     @patch('eol_forum_notifications.utils.course_image_url')
     @patch('eol_forum_notifications.utils.get_course_by_id')
     def test_send_notifications_daily(self, course_mock, image_mock, block_mock):
@@ -246,7 +273,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         """
         course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
         image_mock.return_value = '/assets/image.jpg'
-        block_mock.return_value = {'display_name':'Test discussion xblock', 'parent': 'asdadssa'}
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
         user_notif = EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
         self.discussion.daily_threads = 3
         self.discussion.daily_comment = 3
@@ -266,7 +293,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
 
     @override_settings(PLATFORM_NAME='Test')
     @override_settings(LMS_ROOT_URL='https://test.ts')
-    @patch('eol_forum_notifications.views.get_block_info')
+    @patch('eol_forum_notifications.views.get_blocks_info')
     @patch('eol_forum_notifications.utils.course_image_url')
     @patch('eol_forum_notifications.utils.get_course_by_id')
     def test_send_notifications_weekly(self, course_mock, image_mock, block_mock):
@@ -275,7 +302,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         """
         course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
         image_mock.return_value = '/assets/image.jpg'
-        block_mock.return_value = {'display_name':'Test discussion xblock', 'parent': 'asdadssa'}
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
         user_notif = EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
         self.discussion.daily_threads = 3
         self.discussion.daily_comment = 3
@@ -295,7 +322,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
 
     @override_settings(PLATFORM_NAME='Test')
     @override_settings(LMS_ROOT_URL='https://test.ts')
-    @patch('eol_forum_notifications.views.get_block_info')
+    @patch('eol_forum_notifications.views.get_blocks_info')
     @patch('eol_forum_notifications.utils.course_image_url')
     @patch('eol_forum_notifications.utils.get_course_by_id')
     def test_send_notifications_daily_no_users(self, course_mock, image_mock, block_mock):
@@ -304,7 +331,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         """
         course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
         image_mock.return_value = '/assets/image.jpg'
-        block_mock.return_value = {'display_name':'Test discussion xblock', 'parent': 'asdadssa'}
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
         self.discussion.daily_threads = 3
         self.discussion.daily_comment = 3
         self.discussion.weekly_threads = 3
@@ -323,7 +350,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
 
     @override_settings(PLATFORM_NAME='Test')
     @override_settings(LMS_ROOT_URL='https://test.ts')
-    @patch('eol_forum_notifications.views.get_block_info')
+    @patch('eol_forum_notifications.views.get_blocks_info')
     @patch('eol_forum_notifications.utils.course_image_url')
     @patch('eol_forum_notifications.utils.get_course_by_id')
     def test_send_notifications_daily_empty_block_parents(self, course_mock, image_mock, block_mock):
@@ -334,7 +361,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         """
         course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
         image_mock.return_value = '/assets/image.jpg'
-        block_mock.return_value = {'display_name':'Test discussion xblock', 'parent': ''}
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': ''})
         self.discussion.daily_threads = 3
         self.discussion.daily_comment = 3
         self.discussion.weekly_threads = 3
@@ -343,9 +370,15 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         with self.assertLogs('eol_forum_notifications.views', level='INFO') as cm:
             send_notification('daily')
         self.assertTrue(any('INFO:eol_forum_notifications.views:EolForumNotification - Block id doesnt exists, block-v1:eol+test100+2021_1+type@eoldiscussion+block@5c13942678184cab9a5345b660292c6e, course: foo/baz/bar' in log for log in cm.output))
+        # the discussion is saved as notified, the next runs do not look up its block again
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_threads, aux.daily_comment, aux.daily_pending), (0, 0, False))
+        self.assertEqual((aux.weekly_threads, aux.weekly_comment), (3, 3))
+        send_notification('daily')
+        self.assertEqual(block_mock.call_count, 1)
 
     @patch('eol_forum_notifications.views.get_current_site')
-    @patch('eol_forum_notifications.views.get_block_info')
+    @patch('eol_forum_notifications.views.get_blocks_info')
     @patch('eol_forum_notifications.utils.course_image_url')
     @patch('eol_forum_notifications.utils.get_course_by_id')
     def test_send_notifications_test_get_current_site(self, course_mock, image_mock, block_mock, mock_get_current_site):
@@ -365,7 +398,7 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         
         course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
         image_mock.return_value = '/assets/image.jpg'
-        block_mock.return_value = {'display_name':'Test discussion xblock', 'parent': 'parent_test'}
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'parent_test'})
         self.discussion.daily_threads = 3
         self.discussion.daily_comment = 3
         self.discussion.weekly_threads = 3
@@ -379,6 +412,446 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         'EolForumNotification - Error to get platform name and url site' in log
         for log in cm.output))
 
+    @override_settings(PLATFORM_NAME='Test')
+    @override_settings(LMS_ROOT_URL='https://test.ts')
+    @patch('eol_forum_notifications.tasks.task_send_bulk_email.delay')
+    @patch('eol_forum_notifications.views.get_blocks_info')
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_send_notifications_digest(self, course_mock, image_mock, block_mock, bulk_mock):
+        """
+            test send_notifications() digest mode sends one email per user with all his discussions
+        """
+        course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
+        image_mock.return_value = '/assets/image.jpg'
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
+        discussion_2 = EolForumNotificationsDiscussions.objects.create(
+            discussion_id="0987654321",
+            course_id=self.course.id,
+            block_key=self.block_key,
+            daily_threads=1
+            )
+        self.discussion.daily_comment = 3
+        self.discussion.save()
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        EolForumNotificationsUser.objects.create(discussion=discussion_2, user=self.student, how_often="daily")
+        EolForumNotificationsUser.objects.create(discussion=discussion_2, user=self.student2, how_often="daily")
+        send_notification('daily', digest=True)
+        bulk_mock.assert_called_once()
+        digests = {context['user_id']: context for context in bulk_mock.call_args[0][0]}
+        self.assertEqual(len(digests), 2)
+        self.assertEqual(digests[self.student.id]['email'], self.student.email)
+        self.assertEqual(
+            sorted(d['discussion_id'] for d in digests[self.student.id]['discussions']),
+            ['0987654321', '1234567890'])
+        self.assertEqual(len(digests[self.student2.id]['discussions']), 1)
+        aux = EolForumNotificationsDiscussions.objects.get(id=discussion_2.id)
+        self.assertEqual(aux.daily_threads, 0)
+
+    def test_get_email_message_digest(self):
+        """
+            test get_email_message() renders every discussion of a digest email
+        """
+        discussion_context = {
+            'course_name': 'course name',
+            'course_id': str(self.course.id),
+            'daily_threads': 2,
+            'daily_comment': 0,
+            'parent': 'parent_test',
+            'notif_url': 'https://test.ts/notif'
+        }
+        context = {
+            'user_id': self.student.id,
+            'email': self.student.email,
+            'platform_name': 'Test',
+            'url_site': 'https://test.ts',
+            'how_often': 'daily',
+            'discussions': [
+                dict(discussion_context, discussion_name='first discussion'),
+                dict(discussion_context, discussion_name='second discussion')
+            ]
+        }
+        subject, plain_message, html_message = get_email_message(context)
+        self.assertEqual(subject, 'Nueva actividad en el foro de Test')
+        self.assertIn('first discussion', html_message)
+        self.assertIn('second discussion', html_message)
+        self.assertIn('Hoy se han realizado 2 publicaciones en el foro.', plain_message)
+        self.assertIn('second discussion: Hoy se han realizado 2 publicaciones en el foro.', plain_message)
+        self.assertNotIn('<', plain_message)
+
+    def test_get_email_message_plain_template(self):
+        """
+            test get_email_message() renders the plain text from email.txt, loaded once per process
+        """
+        context = self._get_email_context(self.student)
+        context['discussion_name'] = 'Q&A'
+        subject, plain_message, html_message = get_email_message(context)
+        self.assertIn('Nueva actividad en el foro Q&A del curso course name', plain_message)
+        self.assertIn('Hoy se han realizado 1 publicaciones en el foro.', plain_message)
+        self.assertIn('https://test.ts/notif', plain_message)
+        self.assertNotIn('<', plain_message)
+        self.assertIn('Q&amp;A', html_message)
+        self.assertLess(len(plain_message), len(html_message) // 4)
+        self.assertIs(get_email_template('email.txt'), get_email_template('email.txt'))
+
+    @override_settings(PLATFORM_NAME='Test')
+    @override_settings(LMS_ROOT_URL='https://test.ts')
+    @override_settings(EOL_FORUM_NOTIFICATIONS_EMAIL_CHUNK_SIZE=2)
+    @patch('eol_forum_notifications.tasks.task_send_bulk_email.delay')
+    @patch('eol_forum_notifications.views.get_blocks_info')
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_send_notifications_bulk_chunks(self, course_mock, image_mock, block_mock, bulk_mock):
+        """
+            test send_notifications() enqueues the recipients in chunks of EOL_FORUM_NOTIFICATIONS_EMAIL_CHUNK_SIZE
+        """
+        course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
+        image_mock.return_value = '/assets/image.jpg'
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
+        self.discussion.daily_threads = 1
+        self.discussion.save()
+        for user in [self.student, self.student2, self.staff_user]:
+            EolForumNotificationsUser.objects.create(discussion=self.discussion, user=user, how_often="daily")
+        send_notification('daily')
+        self.assertEqual([len(args[0]) for args, kwargs in bulk_mock.call_args_list], [2, 1])
+        emails = [context['email'] for args, kwargs in bulk_mock.call_args_list for context in args[0]]
+        self.assertEqual(sorted(emails), sorted([self.student.email, self.student2.email, self.staff_user.email]))
+
+    @override_settings(PLATFORM_NAME='Test')
+    @override_settings(LMS_ROOT_URL='https://test.ts')
+    @override_settings(EOL_FORUM_NOTIFICATIONS_EMAIL_CHUNK_SIZE=1)
+    @override_settings(EOL_FORUM_NOTIFICATIONS_SEND_DEADLINE=300)
+    @patch('eol_forum_notifications.tasks.task_send_bulk_email.apply_async')
+    @patch('eol_forum_notifications.tasks.task_send_bulk_email.delay')
+    @patch('eol_forum_notifications.views.get_blocks_info')
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_send_notifications_deadline(self, course_mock, image_mock, block_mock, bulk_mock, async_mock):
+        """
+            test send_notifications() spreads the chunks over EOL_FORUM_NOTIFICATIONS_SEND_DEADLINE with countdowns
+        """
+        course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
+        image_mock.return_value = '/assets/image.jpg'
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
+        self.discussion.daily_threads = 1
+        self.discussion.save()
+        for user in [self.student, self.student2, self.staff_user]:
+            EolForumNotificationsUser.objects.create(discussion=self.discussion, user=user, how_often="daily")
+        report = send_notification('daily')
+        # 3 subscribers (+1 of the estimate) in 300 seconds, one chunk every 75 seconds
+        self.assertEqual(bulk_mock.call_count, 1)
+        countdowns = [kwargs['countdown'] for args, kwargs in async_mock.call_args_list]
+        self.assertEqual(len(countdowns), 2)
+        self.assertAlmostEqual(countdowns[0], 75, delta=5)
+        self.assertAlmostEqual(countdowns[1], 150, delta=5)
+        self.assertIn('count_subscribers', report.as_dict()['phases'])
+
+    def test_task_send_bulk_email(self):
+        """
+            test task_send_bulk_email() sends every recipient over a single connection
+        """
+        contexts = [self._get_email_context(user) for user in [self.student, self.student2]]
+        with patch('eol_forum_notifications.tasks.get_connection', wraps=get_connection) as connection_mock:
+            sent = task_send_bulk_email(contexts)
+        connection_mock.assert_called_once()
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, [self.student.email])
+        self.assertEqual(mail.outbox[1].alternatives[0][1], 'text/html')
+
+    @override_settings(EOL_FORUM_NOTIFICATIONS_METRICS={'BACKEND': 'eol_forum_notifications.metrics.MemoryMetrics'})
+    def test_task_send_bulk_email_metrics(self):
+        """
+            test task_send_bulk_email() sends render and smtp timings
+        """
+        contexts = [self._get_email_context(user) for user in [self.student, self.student2]]
+        task_send_bulk_email(contexts)
+        metrics = get_metrics()
+        self.assertEqual(len(metrics.timings['email.render']), 1)
+        self.assertEqual(len(metrics.timings['email.smtp']), 2)
+        self.assertEqual(metrics.counters['email.sent'], 2)
+
+    @patch('eol_forum_notifications.tasks.task_send_bulk_email.retry')
+    @patch('eol_forum_notifications.tasks.get_connection')
+    def test_task_send_bulk_email_retry_failed(self, connection_mock, retry_mock):
+        """
+            test task_send_bulk_email() only retries the recipients that failed
+        """
+        retry_mock.return_value = Exception('retry')
+        connection = MagicMock()
+        connection.send_messages.side_effect = [1, Exception('smtp error')]
+        connection_mock.return_value = connection
+        contexts = [self._get_email_context(user) for user in [self.student, self.student2]]
+        with self.assertRaises(Exception):
+            task_send_bulk_email(contexts)
+        retry_mock.assert_called_once_with(args=[[contexts[1]]])
+        connection.open.assert_called_once()
+        connection.close.assert_called_once()
+
+    def test_benchmark_email(self):
+        """
+            test benchmark_email() sends every synthetic recipient with single and bulk tasks
+        """
+        result = benchmark.benchmark_email(recipients=3, chunk_size=2)
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(result['recipients'], 3)
+        self.assertIn('per_second', result['single'])
+        self.assertIn('per_second', result['bulk'])
+
+    def test_get_email_messages_render_once(self):
+        """
+            test get_email_messages() renders once per discussion and replaces the recipient fields
+        """
+        contexts = [self._get_email_context(user) for user in [self.student, self.student2]]
+        contexts[0]['notif_url'] = 'https://test.ts/notif?user_id=1&course_id=2'
+        with patch('eol_forum_notifications.tasks.get_email_message', wraps=get_email_message) as render_mock:
+            messages = get_email_messages(contexts)
+        render_mock.assert_called_once()
+        self.assertEqual(len(messages), 2)
+        for context, (subject, plain_message, html_message) in zip(contexts, messages):
+            self.assertEqual((subject, plain_message, html_message), get_email_message(context))
+        self.assertIn('https://test.ts/notif?user_id=1&amp;course_id=2', messages[0][2])
+        self.assertIn('https://test.ts/notif?user_id=1&course_id=2', messages[0][1])
+        self.assertNotIn('@@EOL_FORUM_NOTIFICATIONS_', messages[1][2])
+
+    def test_benchmark_render(self):
+        """
+            test benchmark_render() reports per recipient and per discussion render cost
+        """
+        result = benchmark.benchmark_render(recipients=3)
+        self.assertEqual(result['recipients'], 3)
+        self.assertIn('ms', result['per_recipient'])
+        self.assertIn('ms', result['per_discussion'])
+
+    def test_benchmark_pipeline(self):
+        """
+            test benchmark_pipeline() times every function and rolls back the fixtures
+        """
+        # a real course with pending activity and a subscriber must not be notified by the benchmark
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        self.discussion.daily_threads = 1
+        self.discussion.save()
+        record_activity(self.course.id, '1234567890', 'comment')
+        with patch('eol_forum_notifications.views.get_discussions_onlive', wraps=get_discussions_onlive) as discussions_mock, \
+                patch('eol_forum_notifications.utils.get_courses_metadata', wraps=get_courses_metadata) as metadata_mock:
+            result = benchmark.benchmark_pipeline([(1, 2, 2)])
+        self.assertTrue(all(args[0].startswith('course-v1:{}+'.format(benchmark.BENCHMARK_PREFIX)) for args, kwargs in discussions_mock.call_args_list))
+        self.assertTrue(all(str(course_key).startswith('course-v1:{}+'.format(benchmark.BENCHMARK_PREFIX)) for args, kwargs in metadata_mock.call_args_list for course_key in args[0]))
+        # the buffered activity is still flushed to the real discussion
+        flush_activity()
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_threads, aux.daily_comment), (1, 1))
+        scale = result['scales'][0]
+        self.assertEqual((scale['courses'], scale['discussions'], scale['subscribers']), (1, 2, 2))
+        for name in ['get_courses_onlive', 'get_discussions_users_notifications', 'send_notification', 'save', 'get_save', 'post_save']:
+            self.assertIn('seconds', scale['results'][name])
+            self.assertIn('queries', scale['results'][name])
+        self.assertFalse(EolForumNotificationsDiscussions.objects.filter(discussion_id__startswith=benchmark.BENCHMARK_PREFIX).exists())
+        self.assertFalse(User.objects.filter(username__startswith=benchmark.BENCHMARK_PREFIX).exists())
+
+    def test_benchmark_save_load_fixtures(self):
+        """
+            test benchmark_save_load() creates fixtures without activity and only deletes the users it created
+        """
+        other = User.objects.create(username='{}_other'.format(benchmark.BENCHMARK_PREFIX), email='other@example.com')
+
+        def fail(*args, **kwargs):
+            discussions = EolForumNotificationsDiscussions.objects.filter(discussion_id__startswith=benchmark.BENCHMARK_PREFIX)
+            self.assertEqual(list(discussions.values_list('daily_threads', 'daily_pending', 'weekly_pending')), [(0, False, False)])
+            raise RuntimeError('benchmark error')
+        with patch('eol_forum_notifications.benchmark.ThreadPoolExecutor', side_effect=fail):
+            with self.assertRaises(RuntimeError):
+                benchmark.benchmark_save_load(clients=2, requests=1)
+        self.assertFalse(EolForumNotificationsDiscussions.objects.filter(discussion_id__startswith=benchmark.BENCHMARK_PREFIX).exists())
+        self.assertEqual(list(User.objects.filter(username__startswith=benchmark.BENCHMARK_PREFIX).values_list('id', flat=True)), [other.id])
+
+    def _get_email_context(self, user):
+        """
+            return email context of self.discussion for user
+        """
+        return {
+            'user_id': user.id,
+            'email': user.email,
+            'course_name': 'course name',
+            'image': '/assets/image.jpg',
+            'platform_name': 'Test',
+            'url_site': 'https://test.ts',
+            'how_often': 'daily',
+            'discussion_name': 'discussion name',
+            'parent': 'parent_test',
+            'course_id': str(self.course.id),
+            'notif_url': 'https://test.ts/notif',
+            'discussion_id': self.discussion.discussion_id,
+            'daily_threads': 1,
+            'daily_comment': 0,
+            'weekly_threads': 0,
+            'weekly_comment': 0
+        }
+
+    @override_settings(PLATFORM_NAME='Test')
+    @override_settings(LMS_ROOT_URL='https://test.ts')
+    @patch('eol_forum_notifications.views.get_blocks_info')
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_send_notifications_keeps_new_activity(self, course_mock, image_mock, block_mock):
+        """
+            test send_notifications() only subtracts the notified counts, activity posted during the run is kept
+        """
+        course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)]
+        image_mock.return_value = '/assets/image.jpg'
+        def blocks_info(block_keys, cache=None):
+            # new thread posted after the counters were read
+            EolForumNotificationsDiscussions.objects.filter(id=self.discussion.id).update(daily_threads=F('daily_threads') + 1)
+            return {str(block_key): {'display_name':'Test discussion xblock', 'parent': 'asdadssa'} for block_key in block_keys}
+        block_mock.side_effect = blocks_info
+        self.discussion.daily_threads = 3
+        self.discussion.daily_comment = 2
+        self.discussion.save()
+        send_notification('daily')
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual(aux.daily_threads, 1)
+        self.assertEqual(aux.daily_comment, 0)
+
+    def test_utils_reset_discussions_counters(self):
+        """
+            test reset_discussions_counters() updates discussions with the same counts together
+        """
+        discussions = [self.discussion]
+        for i in range(3):
+            discussions.append(EolForumNotificationsDiscussions.objects.create(
+                discussion_id="discussion_{}".format(i),
+                course_id=self.course.id,
+                block_key=self.block_key))
+        for discussion, counts in zip(discussions, [(2, 1), (2, 1), (1, 0), (0, 0)]):
+            discussion.weekly_threads, discussion.weekly_comment = counts
+            discussion.daily_threads = 5
+            discussion.save()
+        values = list(EolForumNotificationsDiscussions.objects.values('id', 'weekly_threads', 'weekly_comment'))
+        with self.assertNumQueries(2):
+            self.assertEqual(reset_discussions_counters('weekly', values), 2)
+        self.assertFalse(EolForumNotificationsDiscussions.objects.exclude(weekly_threads=0, weekly_comment=0).exists())
+        self.assertEqual(EolForumNotificationsDiscussions.objects.filter(daily_threads=5).count(), 4)
+        self.assertFalse(EolForumNotificationsDiscussions.objects.filter(weekly_pending=True).exists())
+        self.assertEqual(EolForumNotificationsDiscussions.objects.filter(daily_pending=True).count(), 4)
+
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_utils_pending_discussions(self, course_mock, image_mock):
+        """
+            test the pending flags follow flushed activity and resets, and only courses with pending discussions are selected
+        """
+        course_mock.return_value = namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)
+        image_mock.return_value = '/assets/image.jpg'
+        self.assertFalse(self.discussion.daily_pending)
+        self.assertEqual(list(get_courses_onlive(how_often='daily')), [])
+        self.assertEqual(list(get_discussions_onlive(str(self.course.id), 'daily')), [])
+        record_activity(self.course.id, '1234567890', 'threads')
+        flush_activity()
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertTrue(aux.daily_pending)
+        self.assertTrue(aux.weekly_pending)
+        self.assertEqual([course_id for course_id, data in get_courses_onlive(how_often='daily')], [str(self.course.id)])
+        discussions = [discussion for chunk in get_discussions_onlive(str(self.course.id), 'daily') for discussion in chunk]
+        # a new thread arrives before the reset, the discussion stays pending
+        EolForumNotificationsDiscussions.objects.filter(id=self.discussion.id).update(daily_threads=F('daily_threads') + 1)
+        reset_discussions_counters('daily', discussions)
+        self.assertTrue(EolForumNotificationsDiscussions.objects.get(id=self.discussion.id).daily_pending)
+        discussions = [discussion for chunk in get_discussions_onlive(str(self.course.id), 'daily') for discussion in chunk]
+        reset_discussions_counters('daily', discussions)
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertFalse(aux.daily_pending)
+        self.assertTrue(aux.weekly_pending)
+        self.assertEqual(list(get_courses_onlive(how_often='daily')), [])
+
+    @override_settings(PLATFORM_NAME='Test')
+    @override_settings(LMS_ROOT_URL='https://test.ts')
+    @patch('eol_forum_notifications.tasks.task_send_bulk_email.delay')
+    @patch('eol_forum_notifications.views.get_blocks_info')
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_send_notifications_resume_run(self, course_mock, image_mock, block_mock, bulk_mock):
+        """
+            test send_notifications() resumes an unfinished run skipping the discussions already notified
+        """
+        course_mock.return_value = namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)
+        image_mock.return_value = '/assets/image.jpg'
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
+        discussion_2 = EolForumNotificationsDiscussions.objects.create(
+            discussion_id="0987654321",
+            course_id=self.course.id,
+            block_key=self.block_key,
+            daily_threads=1
+            )
+        self.discussion.daily_threads = 2
+        self.discussion.save()
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        EolForumNotificationsUser.objects.create(discussion=discussion_2, user=self.student2, how_often="daily")
+        run = NotificationRun.objects.create(how_often='daily')
+        NotificationRunDiscussion.objects.create(run=run, discussion=self.discussion)
+        send_notification('daily')
+        contexts = [context for args, kwargs in bulk_mock.call_args_list for context in args[0]]
+        self.assertEqual([context['email'] for context in contexts], [self.student2.email])
+        self.assertEqual(contexts[0]['idempotency_key'], '{}:{}:{}'.format(run.id, discussion_2.id, self.student2.id))
+        run.refresh_from_db()
+        self.assertIsNotNone(run.finished_at)
+        # the ledger of a finished run is deleted
+        self.assertFalse(NotificationRunDiscussion.objects.filter(run=run).exists())
+        self.assertEqual(EolForumNotificationsDiscussions.objects.get(id=self.discussion.id).daily_threads, 2)
+        self.assertEqual(EolForumNotificationsDiscussions.objects.get(id=discussion_2.id).daily_threads, 0)
+        # a finished run is not resumed
+        send_notification('daily')
+        self.assertEqual(NotificationRun.objects.filter(how_often='daily').count(), 2)
+
+    def test_utils_get_notification_run(self):
+        """
+            test get_notification_run() only resumes recent unfinished runs with the same parameters
+        """
+        run = get_notification_run('daily')
+        self.assertEqual(get_notification_run('daily'), run)
+        self.assertNotEqual(get_notification_run('weekly'), run)
+        self.assertNotEqual(get_notification_run('daily', shards=2, shard_index=1), run)
+        NotificationRun.objects.filter(id=run.id).update(started_at=now() - timedelta(days=1))
+        self.assertNotEqual(get_notification_run('daily'), run)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'eol_forum_notifications_sent'}})
+    def test_task_send_bulk_email_idempotency_key(self):
+        """
+            test task_send_bulk_email() does not send twice a recipient with the same idempotency_key
+        """
+        contexts = [self._get_email_context(user) for user in [self.student, self.student2]]
+        contexts[0]['idempotency_key'] = '1:1:{}'.format(self.student.id)
+        task_send_bulk_email(contexts)
+        task_send_bulk_email(contexts)
+        self.assertEqual([message.to for message in mail.outbox], [[self.student.email], [self.student2.email], [self.student2.email]])
+
+    @override_settings(PLATFORM_NAME='Test')
+    @override_settings(LMS_ROOT_URL='https://test.ts')
+    @patch('eol_forum_notifications.tasks.task_send_bulk_email.delay')
+    @patch('eol_forum_notifications.views.get_blocks_info')
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_send_notifications_dry_run(self, course_mock, image_mock, block_mock, bulk_mock):
+        """
+            test send_notifications() dry run reports the run without enqueuing emails nor resetting counters
+        """
+        course_mock.return_value = namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)
+        image_mock.return_value = '/assets/image.jpg'
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
+        self.discussion.daily_threads = 2
+        self.discussion.save()
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student2, how_often="daily")
+        report = send_notification('daily', dry_run=True)
+        bulk_mock.assert_not_called()
+        self.assertEqual(EolForumNotificationsDiscussions.objects.get(id=self.discussion.id).daily_threads, 2)
+        self.assertFalse(NotificationRun.objects.exists())
+        data = report.as_dict()
+        self.assertEqual(data['counters'], {'courses': 1, 'discussions': 1, 'recipients': 2, 'emails_enqueued': 2})
+        for phase in ['total', 'get_courses_onlive', 'get_discussions_onlive', 'get_block_info', 'get_users_notifications']:
+            self.assertIn(phase, data['phases'])
+        self.assertNotIn('task_enqueue', data['phases'])
+        self.assertGreater(data['phases']['get_users_notifications']['queries'], 0)
+
     @patch('eol_forum_notifications.utils.get_info_block_course')
     def test_save_notifications_get(self, block_course):
         """
@@ -643,6 +1116,178 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         response_data = json.loads(response)
         self.assertEqual(response_data['how_often'], 'daily')
 
+    def test_utils_get_user_data_cached(self):
+        """
+        Test get_user_data loads the discussions of the course once and the save views invalidate them
+        """
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        with self.assertNumQueries(1):
+            self.assertEqual(json.loads(get_user_data('1234567890', self.student, self.course.id, self.block_key))['how_often'], 'daily')
+        with self.assertNumQueries(0):
+            self.assertEqual(json.loads(get_user_data('1234567890', self.student, self.course.id, self.block_key))['how_often'], 'daily')
+        get_user_data('new_discussion', self.student, self.course.id, self.block_key)
+        self.assertTrue(EolForumNotificationsDiscussions.objects.filter(discussion_id='new_discussion', course_id=self.course.id).exists())
+        # the map is reloaded once after the insert
+        with self.assertNumQueries(1):
+            self.assertEqual(get_user_data('new_discussion', self.student, self.course.id, self.block_key), '{}')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_data('new_discussion', self.student, self.course.id, self.block_key), '{}')
+        post_data = {
+            'discussion_id': '1234567890',
+            'course_id': str(self.course.id),
+            'user_id': str(self.student.id),
+            'period': 'weekly'
+        }
+        response = self.client.post(reverse('eol_discussion_notification:save'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(get_user_data('1234567890', self.student, self.course.id, self.block_key))['how_often'], 'weekly')
+
+    def test_utils_get_users_data(self):
+        """
+        Test get_users_data returns every discussion and creates the missing ones with constant queries
+        """
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="weekly")
+        discussions = [('1234567890', self.block_key)] + [('discussion_{}'.format(i), self.block_key) for i in range(10)]
+        with self.assertNumQueries(2):
+            data = get_users_data(discussions, self.student, self.course.id)
+        self.assertEqual(len(data), 11)
+        self.assertEqual(json.loads(data['1234567890'])['how_often'], 'weekly')
+        self.assertEqual(data['discussion_5'], '{}')
+        self.assertEqual(EolForumNotificationsDiscussions.objects.filter(course_id=self.course.id).count(), 11)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_users_data(discussions, self.student, self.course.id), data)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_users_data(discussions, self.student, self.course.id), data)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_users_data(discussions, self.student2, self.course.id)['1234567890'], '{}')
+
+    def test_utils_get_users_data_concurrent_save(self):
+        """
+        Test get_users_data does not cache the map read before a concurrent save
+        """
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="weekly")
+        bulk_create = EolForumNotificationsDiscussions.objects.bulk_create
+
+        def save_and_bulk_create(*args, **kwargs):
+            upsert_user_notification(self.student.id, '1234567890', self.course.id, 'daily')
+            invalidate_user_discussions(self.student, self.course.id)
+            return bulk_create(*args, **kwargs)
+        with patch.object(EolForumNotificationsDiscussions.objects, 'bulk_create', side_effect=save_and_bulk_create):
+            get_users_data([('1234567890', self.block_key), ('new_discussion', self.block_key)], self.student, self.course.id)
+        self.assertEqual(json.loads(get_users_data([('1234567890', self.block_key)], self.student, self.course.id)['1234567890'])['how_often'], 'daily')
+
+    def test_how_often_small_integer(self):
+        """
+        Test how_often is stored as a small integer and read, filtered and updated by name
+        """
+        user_notif = EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="weekly")
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT how_often FROM {} WHERE id = %s'.format(EolForumNotificationsUser._meta.db_table), [user_notif.id])
+            self.assertEqual(cursor.fetchone()[0], 2)
+        self.assertEqual(EolForumNotificationsUser.objects.get(id=user_notif.id).how_often, 'weekly')
+        self.assertEqual(list(EolForumNotificationsUser.objects.filter(how_often='weekly').values_list('how_often', flat=True)), ['weekly'])
+        upsert_user_notification(self.student.id, '1234567890', self.course.id, 'daily')
+        self.assertEqual(EolForumNotificationsUser.objects.get(id=user_notif.id).how_often, 'daily')
+        self.assertEqual(user_notif.get_how_often_display(), 'weekly')
+
+    @skipUnless(connection.vendor in ('sqlite', 'mysql'), 'query plan checked on SQLite and MySQL')
+    def test_how_often_covering_index(self):
+        """
+        Test get_discussions_users_notifications reads the subscribers from the (discussion, how_often, id, user) index
+        """
+        discussion_2 = EolForumNotificationsDiscussions.objects.create(discussion_id="0987654321", course_id=self.course.id)
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        with CaptureQueriesContext(connection) as queries:
+            list(get_discussions_users_notifications('daily', [self.discussion.id, discussion_2.id]))
+        with connection.cursor() as cursor:
+            cursor.execute('{} {}'.format('EXPLAIN QUERY PLAN' if connection.vendor == 'sqlite' else 'EXPLAIN', queries[0]['sql']))
+            plan = str(cursor.fetchall())
+        self.assertIn('eol_forum_notif_keyset_idx', plan)
+        if connection.vendor == 'sqlite':
+            self.assertIn('COVERING INDEX', plan)
+
+    def test_utils_upsert_user_notification(self):
+        """
+        Test upsert_user_notification inserts, updates in one statement and fails without discussion
+        """
+        with self.assertNumQueries(1):
+            self.assertTrue(upsert_user_notification(self.student.id, '1234567890', self.course.id, 'daily'))
+        self.assertTrue(upsert_user_notification(self.student.id, '1234567890', self.course.id, 'weekly'))
+        self.assertTrue(upsert_user_notification(self.student.id, '1234567890', self.course.id, 'weekly'))
+        self.assertEqual(EolForumNotificationsUser.objects.get(user=self.student, discussion=self.discussion).how_often, 'weekly')
+        self.assertEqual(EolForumNotificationsUser.objects.filter(user=self.student).count(), 1)
+        self.assertFalse(upsert_user_notification(self.student.id, 'wrong_discussion', self.course.id, 'daily'))
+        self.assertEqual(EolForumNotificationsUser.objects.filter(user=self.student).count(), 1)
+
+    def test_save_course_notification(self):
+        """
+        Test save_course view sets the period of every discussion of the course, or only the given ones
+        """
+        discussion2 = EolForumNotificationsDiscussions.objects.create(discussion_id="0987654321", course_id=self.course.id)
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="weekly")
+        post_data = {
+            'course_id': str(self.course.id),
+            'user_id': str(self.student.id),
+            'period': 'daily'
+        }
+        response = self.client.post(reverse('eol_discussion_notification:save_course'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['discussions'], 2)
+        self.assertEqual(EolForumNotificationsUser.objects.filter(user=self.student, how_often='daily').count(), 2)
+        post_data['period'] = 'never'
+        post_data['discussion_ids'] = ['0987654321']
+        response = self.client.post(reverse('eol_discussion_notification:save_course'), post_data)
+        self.assertEqual(json.loads(response.content.decode())['discussions'], 1)
+        self.assertEqual(EolForumNotificationsUser.objects.get(user=self.student, discussion=discussion2).how_often, 'never')
+        self.assertEqual(EolForumNotificationsUser.objects.get(user=self.student, discussion=self.discussion).how_often, 'daily')
+        post_data['user_id'] = str(self.student2.id)
+        response = self.client.post(reverse('eol_discussion_notification:save_course'), post_data)
+        self.assertEqual(response.status_code, 400)
+
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    @patch('eol_forum_notifications.utils.get_block_info')
+    def test_utils_get_info_block_course_cached(self, block_info, course_by_id):
+        """
+        Test get_info_block_course caches the names until the CourseOverview is modified
+        """
+        block_info.return_value = {'display_name': 'discussion name', 'parent': 'parent'}
+        course_by_id.return_value = namedtuple('Course', ['display_name_with_default'])('course name')
+        expected = {'course_name': 'course name', 'discussion_name': 'discussion name'}
+        overview = CourseOverviewFactory.create(id=self.course.id)
+        self.assertEqual(get_info_block_course('1234567890', str(self.course.id)), expected)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_info_block_course('1234567890', str(self.course.id)), expected)
+        self.assertEqual(block_info.call_count, 1)
+        CourseOverview.objects.filter(id=overview.id).update(modified=overview.modified + timedelta(seconds=1))
+        self.assertEqual(get_info_block_course('1234567890', str(self.course.id), self.discussion), expected)
+        self.assertEqual(block_info.call_count, 2)
+
+    @patch('eol_forum_notifications.views.render')
+    @patch('eol_forum_notifications.views.get_info_block_course')
+    def test_save_notifications_get_single_query(self, block_course, render_mock):
+        """
+            test save_notifications_get() gets the discussion and the user model in one query
+        """
+        block_course.return_value = {
+            'course_name': 'course name',
+            'discussion_name': 'discussion name'
+        }
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        request = TestRequest()
+        request.method = 'GET'
+        request.user = self.student
+        request.GET = {
+            'discussion_id': self.discussion.discussion_id,
+            'course_id': str(self.course.id),
+            'user_id': str(self.student.id),
+        }
+        render_mock.return_value = HttpResponse(status=200)
+        with self.assertNumQueries(1):
+            response = save_notification_get(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(block_course.call_args[0][2], self.discussion)
+        self.assertEqual(render_mock.call_args[0][2]['period'], 'daily')
+
     def test_utils_get_info_block_course_wrong_user_id(self):
         """
         Test error when user in notification is different from request user
@@ -679,6 +1324,326 @@ class TestNotifiactionsDiscussion(UrlResetMixin, ModuleStoreTestCase):
         }
         self.assertEqual(result, expected)
 
+    def test_utils_get_discussions_users_notifications(self):
+        """
+        Test get_discussions_users_notifications yields the users subscribed in the period to the discussions
+        """
+        discussion_2 = EolForumNotificationsDiscussions.objects.create(
+            discussion_id="0987654321",
+            course_id=self.course.id,
+            block_key=self.block_key,
+            weekly_threads=1
+            )
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student, how_often="daily")
+        EolForumNotificationsUser.objects.create(discussion=self.discussion, user=self.student2, how_often="weekly")
+        EolForumNotificationsUser.objects.create(discussion=discussion_2, user=self.student, how_often="daily")
+        EolForumNotificationsUser.objects.create(discussion=discussion_2, user=self.student2, how_often="weekly")
+        daily = list(get_discussions_users_notifications('daily', [self.discussion.id]))
+        self.assertEqual([(u['discussion_id'], u['user__id'], u['user__email']) for u in daily], [
+            (self.discussion.id, self.student.id, self.student.email)
+        ])
+        weekly = list(get_discussions_users_notifications('weekly', [self.discussion.id, discussion_2.id]))
+        self.assertEqual([(u['discussion_id'], u['user__id']) for u in weekly], [
+            (self.discussion.id, self.student2.id),
+            (discussion_2.id, self.student2.id)
+        ])
+        self.assertEqual(list(get_discussions_users_notifications('weekly', [])), [])
+
+    def test_utils_get_discussions_users_notifications_query_count(self):
+        """
+        Test get_discussions_users_notifications query count does not grow with the number of discussions
+        """
+        discussion_ids = []
+        for i in range(10):
+            discussion = EolForumNotificationsDiscussions.objects.create(
+                discussion_id="discussion_{}".format(i),
+                course_id=self.course.id,
+                block_key=self.block_key,
+                daily_threads=1
+                )
+            EolForumNotificationsUser.objects.create(discussion=discussion, user=self.student, how_often="daily")
+            discussion_ids.append(discussion.id)
+        with self.assertNumQueries(1):
+            notifications = list(get_discussions_users_notifications('daily', discussion_ids))
+        self.assertEqual(len(notifications), 10)
+        with self.assertNumQueries(3):
+            notifications = list(get_discussions_users_notifications('daily', discussion_ids, chunk_size=4))
+        self.assertEqual(len(notifications), 10)
+
+    def test_utils_get_discussions_onlive(self):
+        """
+        Test get_discussions_onlive yields chunks of the course discussions with activity in the period
+        """
+        for i in range(5):
+            EolForumNotificationsDiscussions.objects.create(
+                discussion_id="discussion_{}".format(i),
+                course_id=self.course.id,
+                block_key=self.block_key,
+                daily_comment=i
+                )
+        chunks = list(get_discussions_onlive(str(self.course.id), 'daily', chunk_size=2))
+        self.assertEqual([[d['discussion_id'] for d in chunk] for chunk in chunks], [
+            ['discussion_1', 'discussion_2'],
+            ['discussion_3', 'discussion_4']
+        ])
+        self.assertEqual(list(get_discussions_onlive(str(self.course.id), 'weekly')), [])
+
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_utils_get_courses_onlive_course_overview(self, course_mock):
+        """
+        Test get_courses_onlive reads course data from CourseOverview without loading the course
+        """
+        CourseOverviewFactory.create(id=self.course.id, display_name='overview name', end=None)
+        with self.assertNumQueries(2):
+            courses = dict(get_courses_onlive())
+        course_mock.assert_not_called()
+        self.assertEqual(courses[str(self.course.id)]['course_name'], 'overview name')
+
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_utils_get_courses_onlive_shards(self, course_mock):
+        """
+        Test get_courses_onlive splits the courses between shards without loading the other shards courses
+        """
+        course_2 = CourseKey.from_string('course-v1:eol+test200+2021_1')
+        EolForumNotificationsDiscussions.objects.create(discussion_id="0987654321", course_id=course_2, block_key=self.block_key)
+        CourseOverviewFactory.create(id=self.course.id, end=None)
+        CourseOverviewFactory.create(id=course_2, end=None)
+        shards = 4
+        self.assertEqual(get_course_shard(str(self.course.id), shards), get_course_shard(self.course.id, shards))
+        courses = []
+        for shard_index in range(shards):
+            shard_courses = [course_id for course_id, data in get_courses_onlive(shards=shards, shard_index=shard_index)]
+            for course_id in shard_courses:
+                self.assertEqual(get_course_shard(course_id, shards), shard_index)
+            courses.extend(shard_courses)
+        self.assertEqual(sorted(courses), sorted([str(self.course.id), str(course_2)]))
+        course_mock.assert_not_called()
+
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_utils_get_courses_onlive_archived(self, course_mock, image_mock):
+        """
+        Test get_courses_onlive falls back to the modulestore and skips archived courses
+        """
+        course_mock.side_effect = [namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", now() - timedelta(days=1))]
+        image_mock.return_value = '/assets/image.jpg'
+        courses = dict(get_courses_onlive())
+        course_mock.assert_called_once_with(self.course.id)
+        self.assertEqual(courses, {})
+        # the end date is saved, the next runs filter the course in SQL
+        self.assertIsNotNone(EolForumNotificationsDiscussions.objects.get(id=self.discussion.id).course_end)
+        self.assertEqual(dict(get_courses_onlive()), {})
+        course_mock.assert_called_once_with(self.course.id)
+
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_utils_get_courses_onlive_archived_dry_run(self, course_mock, image_mock):
+        """
+        Test get_courses_onlive with dry_run does not save the end date of archived courses
+        """
+        course_mock.return_value = namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", now() - timedelta(days=1))
+        image_mock.return_value = '/assets/image.jpg'
+        self.assertEqual(dict(get_courses_onlive(dry_run=True)), {})
+        self.assertIsNone(EolForumNotificationsDiscussions.objects.get(id=self.discussion.id).course_end)
+
+    def test_utils_refresh_courses_end(self):
+        """
+        Test refresh_courses_end saves the CourseOverview end date of the courses saved as ended
+        """
+        course_2 = CourseKey.from_string('course-v1:eol+test200+2021_1')
+        ended = now() - timedelta(days=1)
+        EolForumNotificationsDiscussions.objects.filter(id=self.discussion.id).update(course_end=ended)
+        EolForumNotificationsDiscussions.objects.create(discussion_id="0987654321", course_id=course_2, course_end=ended)
+        end = now() + timedelta(days=10)
+        CourseOverviewFactory.create(id=self.course.id, end=end)
+        CourseOverviewFactory.create(id=course_2, end=ended)
+        self.assertEqual(EolForumNotificationsDiscussions.objects.filter(get_course_live_filter()).count(), 0)
+        shard_index = get_course_shard(self.course.id, 2)
+        self.assertEqual(refresh_courses_end(chunk_size=1, shards=2, shard_index=1 - shard_index), 0)
+        self.assertEqual(refresh_courses_end(chunk_size=1, shards=2, shard_index=shard_index), 1)
+        self.assertEqual(EolForumNotificationsDiscussions.objects.get(id=self.discussion.id).course_end, end)
+        self.assertEqual(list(EolForumNotificationsDiscussions.objects.filter(get_course_live_filter()).values_list('id', flat=True)), [self.discussion.id])
+        self.assertEqual(refresh_courses_end(), 0)
+
+    @override_settings(PLATFORM_NAME='Test')
+    @override_settings(LMS_ROOT_URL='https://test.ts')
+    @override_settings(EOL_FORUM_NOTIFICATIONS_CHUNK_SIZE=50)
+    @patch('eol_forum_notifications.views.get_blocks_info')
+    @patch('eol_forum_notifications.utils.course_image_url')
+    @patch('eol_forum_notifications.utils.get_course_by_id')
+    def test_send_notifications_memory_bounded(self, course_mock, image_mock, block_mock):
+        """
+            test send_notifications() peak memory does not grow with the number of subscribers
+        """
+        course_mock.return_value = namedtuple("Course", ["display_name_with_default", "end"])("this is a display name", None)
+        image_mock.return_value = '/assets/image.jpg'
+        block_mock.side_effect = blocks_info_mock({'display_name':'Test discussion xblock', 'parent': 'asdadssa'})
+        peaks = []
+        for size in [200, 800]:
+            EolForumNotificationsDiscussions.objects.bulk_create([
+                EolForumNotificationsDiscussions(
+                    discussion_id="memory_{}_{}".format(size, i),
+                    course_id=self.course.id,
+                    block_key=self.block_key,
+                    daily_threads=1,
+                    daily_pending=True) for i in range(size // 10)])
+            discussions = list(EolForumNotificationsDiscussions.objects.filter(discussion_id__startswith="memory_{}_".format(size)))
+            User.objects.bulk_create([
+                User(username='memory_{}_{}'.format(size, i), email='memory_{}_{}@edx.org'.format(size, i)) for i in range(size)])
+            users = User.objects.filter(username__startswith='memory_{}_'.format(size)).order_by('id')
+            EolForumNotificationsUser.objects.bulk_create([
+                EolForumNotificationsUser(discussion=discussions[i // 10], user=user, how_often="daily")
+                for i, user in enumerate(users)])
+            with patch.object(task_send_bulk_email, 'delay', new=lambda contexts: None):
+                tracemalloc.start()
+                send_notification('daily')
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        # four times the subscribers must not need twice the memory
+        self.assertLess(peaks[1], peaks[0] * 2)
+
+    @patch('eol_forum_notifications.utils.modulestore')
+    def test_utils_get_blocks_info(self, mock_modulestore):
+        """
+        Test get_blocks_info opens one bulk operation per course and keeps the results in cache
+        """
+        block_key_2 = UsageKey.from_string('block-v1:eol+test100+2021_1+type@eoldiscussion+block@0987654321')
+        mock_store = MagicMock()
+        mock_block = MagicMock()
+        mock_block.display_name = "title test"
+        mock_block.parent = "parent-id"
+        mock_store.get_item.side_effect = [mock_block, Exception('not found')]
+        mock_modulestore.return_value = mock_store
+
+        cache = {}
+        result = get_blocks_info([self.block_key, block_key_2], cache)
+        self.assertEqual(result, {
+            str(self.block_key): {'display_name': "title test", 'parent': "parent-id"},
+            str(block_key_2): {'display_name': 'Discusión', 'parent': ''}
+        })
+        mock_store.bulk_operations.assert_called_once_with(self.block_key.course_key)
+        result = get_blocks_info([self.block_key], cache)
+        self.assertEqual(result, {str(self.block_key): {'display_name': "title test", 'parent': "parent-id"}})
+        self.assertEqual(mock_store.get_item.call_count, 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'eol_forum_notifications_activity'}})
+class TestActivity(TestCase):
+
+    def setUp(self):
+        super(TestActivity, self).setUp()
+        cache.clear()
+        self.course_id = CourseKey.from_string('course-v1:eol+test100+2021_1')
+        self.discussion = EolForumNotificationsDiscussions.objects.create(
+            discussion_id="1234567890",
+            course_id=self.course_id,
+            block_key=UsageKey.from_string('block-v1:eol+test100+2021_1+type@eoldiscussion+block@5c13942678184cab9a5345b660292c6e')
+            )
+
+    def test_record_activity_flush(self):
+        """
+        Test record_activity() buffers the counts until flush_activity() writes daily and weekly counters
+        """
+        for i in range(3):
+            record_activity(self.course_id, "1234567890", 'threads')
+        record_activity(str(self.course_id), "1234567890", 'comment')
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual(aux.daily_threads, 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(flush_activity(), 1)
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_threads, aux.weekly_threads, aux.daily_comment, aux.weekly_comment), (3, 3, 1, 1))
+        with self.assertNumQueries(0):
+            self.assertEqual(flush_activity(), 0)
+        record_activity(self.course_id, "1234567890", 'comment')
+        flush_activity()
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_threads, aux.weekly_threads, aux.daily_comment, aux.weekly_comment), (3, 3, 2, 2))
+
+    @override_settings(EOL_FORUM_NOTIFICATIONS_ACTIVITY_FLUSH_EVERY=2)
+    def test_record_activity_flush_every(self):
+        """
+        Test record_activity() enqueues a flush after EOL_FORUM_NOTIFICATIONS_ACTIVITY_FLUSH_EVERY dirty discussions
+        """
+        EolForumNotificationsDiscussions.objects.create(discussion_id="0987654321", course_id=self.course_id, block_key=None)
+        with patch('eol_forum_notifications.tasks.task_flush_activity.delay') as delay_mock:
+            record_activity(self.course_id, "1234567890", 'threads')
+            delay_mock.assert_not_called()
+            record_activity(self.course_id, "0987654321", 'threads')
+            delay_mock.assert_called_once_with()
+        # nothing is written in the request
+        self.assertEqual(EolForumNotificationsDiscussions.objects.filter(daily_threads=1).count(), 0)
+        self.assertEqual(task_flush_activity(), 2)
+        self.assertEqual(EolForumNotificationsDiscussions.objects.filter(daily_threads=1, weekly_threads=1).count(), 2)
+
+    def test_record_activity_flush_race(self):
+        """
+        Test flush_activity() keeps a reserved position whose entry is not set yet
+        """
+        record_activity(self.course_id, "1234567890", 'threads')
+        entry = cache.get('{}:dirty:1'.format(ACTIVITY_PREFIX))
+        # the entry is set after the flush reads the reserved position
+        cache.delete('{}:dirty:1'.format(ACTIVITY_PREFIX))
+        self.assertEqual(flush_activity(), 0)
+        self.assertEqual(cache.get('{}:flushed'.format(ACTIVITY_PREFIX)), None)
+        cache.set('{}:dirty:1'.format(ACTIVITY_PREFIX), entry)
+        self.assertEqual(flush_activity(), 1)
+        self.assertEqual(cache.get('{}:flushed'.format(ACTIVITY_PREFIX)), 1)
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_threads, aux.weekly_threads), (1, 1))
+        record_activity(self.course_id, "1234567890", 'threads')
+        self.assertEqual(flush_activity(), 1)
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_threads, aux.weekly_threads), (2, 2))
+
+    @patch('eol_forum_notifications.activity.time')
+    def test_record_activity_flush_lost_gap(self, mock_time):
+        """
+        Test flush_activity() skips a missing entry after ACTIVITY_GAP_TIMEOUT
+        """
+        mock_time.time.return_value = 1000
+        EolForumNotificationsDiscussions.objects.create(discussion_id="0987654321", course_id=self.course_id, block_key=None)
+        record_activity(self.course_id, "1234567890", 'threads')
+        record_activity(self.course_id, "0987654321", 'threads')
+        cache.delete('{}:dirty:1'.format(ACTIVITY_PREFIX))
+        self.assertEqual(flush_activity(), 1)
+        self.assertEqual(cache.get('{}:flushed'.format(ACTIVITY_PREFIX)), None)
+        mock_time.time.return_value = 1030
+        self.assertEqual(flush_activity(), 0)
+        self.assertEqual(cache.get('{}:flushed'.format(ACTIVITY_PREFIX)), None)
+        mock_time.time.return_value = 1100
+        self.assertEqual(flush_activity(), 0)
+        self.assertEqual(cache.get('{}:flushed'.format(ACTIVITY_PREFIX)), 2)
+        self.assertEqual(cache.get('{}:gap'.format(ACTIVITY_PREFIX)), None)
+        self.assertEqual(EolForumNotificationsDiscussions.objects.get(discussion_id="0987654321").daily_threads, 1)
+
+    def test_record_activity_flush_seq_reset(self):
+        """
+        Test flush_activity() starts again when the sequence is evicted
+        """
+        cache.set('{}:flushed'.format(ACTIVITY_PREFIX), 50, None)
+        record_activity(self.course_id, "1234567890", 'comment')
+        self.assertEqual(flush_activity(), 1)
+        self.assertEqual(cache.get('{}:flushed'.format(ACTIVITY_PREFIX)), 1)
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_comment, aux.weekly_comment), (1, 1))
+
+    def test_record_activity_wrong_kind(self):
+        """
+        Test record_activity() with a wrong kind
+        """
+        with self.assertRaises(ValueError):
+            record_activity(self.course_id, "1234567890", 'votes')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_record_activity_without_cache(self):
+        """
+        Test record_activity() updates the database directly when the cache can not count
+        """
+        record_activity(self.course_id, "1234567890", 'comment')
+        aux = EolForumNotificationsDiscussions.objects.get(id=self.discussion.id)
+        self.assertEqual((aux.daily_comment, aux.weekly_comment), (1, 1))
+
 
 class CommandTest(TestCase):
     @patch('eol_forum_notifications.management.commands.discussion_notification.send_notification')
@@ -699,3 +1664,237 @@ class CommandTest(TestCase):
         self.assertIn("EolForumNoticationsCommand - how_often must be 'weekly' or 'daily'", str(cm.exception))
         call_command('discussion_notification','daily', stdout=out)
         self.assertTrue(out)
+        mock_send_notification.assert_called_with('daily', digest=False, shards=1, shard_index=0, dry_run=False)
+        call_command('discussion_notification','weekly', '--digest', stdout=out)
+        mock_send_notification.assert_called_with('weekly', digest=True, shards=1, shard_index=0, dry_run=False)
+
+    @patch('eol_forum_notifications.management.commands.discussion_notification.send_notification')
+    def test_command_discussion_notification_shards(self, mock_send_notification):
+        """
+        Test discussion_notification with --shards and --shard-index
+        """
+        out = StringIO()
+        call_command('discussion_notification', 'daily', '--shards', '4', '--shard-index', '3', stdout=out)
+        mock_send_notification.assert_called_with('daily', digest=False, shards=4, shard_index=3, dry_run=False)
+        with self.assertRaises(CommandError):
+            call_command('discussion_notification', 'daily', '--shards', '4', '--shard-index', '4', stdout=out)
+        # without shard-index only a part of the courses would be processed
+        with self.assertRaises(CommandError):
+            call_command('discussion_notification', 'daily', '--shards', '4', stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('discussion_notification', 'daily', '--shards', '2', '--digest', stdout=out)
+        with self.assertRaises(CommandError):
+            call_command('discussion_notification', 'daily', '--workers', '2', '--shard-index', '0', stdout=out)
+
+    @patch('eol_forum_notifications.management.commands.discussion_notification.multiprocessing.get_context')
+    def test_command_discussion_notification_workers(self, mock_get_context):
+        """
+        Test discussion_notification with --workers runs every shard in the pool
+        """
+        pool = mock_get_context.return_value.Pool.return_value.__enter__.return_value
+        call_command('discussion_notification', 'daily', '--workers', '2', '--shards', '3', stdout=StringIO())
+        mock_get_context.return_value.Pool.assert_called_once_with(2)
+        pool.starmap.assert_called_once_with(send_notification_shard, [('daily', 3, 0, False), ('daily', 3, 1, False), ('daily', 3, 2, False)])
+
+    @patch('eol_forum_notifications.management.commands.discussion_notification.send_notification')
+    def test_command_discussion_notification_dry_run_profile(self, mock_send_notification):
+        """
+        Test discussion_notification with --dry-run and --profile prints the report and dumps the profile
+        """
+        report = NotificationReport()
+        report.incr('courses', 2)
+        with report.phase('get_courses_onlive'):
+            pass
+        mock_send_notification.return_value = report
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.prof')
+            call_command('discussion_notification', 'daily', '--dry-run', '--profile', path, stdout=out)
+            self.assertTrue(os.path.exists(path))
+        mock_send_notification.assert_called_with('daily', digest=False, shards=1, shard_index=0, dry_run=True)
+        self.assertIn('courses: 2', out.getvalue())
+        self.assertIn('get_courses_onlive', out.getvalue())
+
+    def test_command_discussion_notification_purge(self):
+        """
+        Test discussion_notification_purge deletes and archives the models of courses ended before --days
+        """
+        user = User.objects.create(username='purge_user', email='purge@edx.org')
+        old_course = CourseKey.from_string('course-v1:eol+old+2020')
+        new_course = CourseKey.from_string('course-v1:eol+new+2020')
+        CourseOverviewFactory.create(id=old_course, end=now() - timedelta(days=400))
+        old_discussions = [EolForumNotificationsDiscussions.objects.create(discussion_id='old_{}'.format(i), course_id=old_course) for i in range(3)]
+        new_discussion = EolForumNotificationsDiscussions.objects.create(discussion_id='new', course_id=new_course, course_end=now() - timedelta(days=10))
+        for discussion in old_discussions + [new_discussion]:
+            EolForumNotificationsUser.objects.create(discussion=discussion, user=user, how_often='daily')
+        old_run = NotificationRun.objects.create(how_often='daily')
+        NotificationRun.objects.filter(id=old_run.id).update(started_at=now() - timedelta(days=2))
+        NotificationRunDiscussion.objects.create(run=old_run, discussion=new_discussion)
+        new_run = NotificationRun.objects.create(how_often='daily')
+        out = StringIO()
+        call_command('discussion_notification_purge', '--days', '365', '--dry-run', stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), {'discussions': 0, 'users': 0, 'runs': 1})
+        self.assertEqual(NotificationRun.objects.count(), 2)
+        self.assertEqual(EolForumNotificationsDiscussions.objects.count(), 4)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive.jsonl')
+            out = StringIO()
+            call_command('discussion_notification_purge', '--days', '365', '--batch-size', '2', '--sleep', '0', '--archive', path, stdout=out)
+            self.assertEqual(json.loads(out.getvalue()), {'discussions': 3, 'users': 3, 'runs': 1})
+            with open(path) as f:
+                rows = [json.loads(line) for line in f]
+        self.assertEqual(sorted(row['model'] for row in rows), ['discussion'] * 3 + ['user'] * 3)
+        self.assertEqual(list(EolForumNotificationsDiscussions.objects.values_list('discussion_id', flat=True)), ['new'])
+        self.assertEqual(EolForumNotificationsUser.objects.count(), 1)
+        self.assertEqual(list(NotificationRun.objects.values_list('id', flat=True)), [new_run.id])
+        self.assertFalse(NotificationRunDiscussion.objects.exists())
+        with self.assertRaises(CommandError):
+            call_command('discussion_notification_purge', '--batch-size', '0', stdout=out)
+
+    @patch('eol_forum_notifications.benchmark.benchmark_email')
+    def test_command_discussion_notification_benchmark(self, mock_benchmark):
+        """
+        Test discussion_notification_benchmark prints the benchmark result as JSON
+        """
+        mock_benchmark.return_value = {'recipients': 10}
+        out = StringIO()
+        call_command('discussion_notification_benchmark', 'email', '--recipients', '10', '--chunk-size', '5', stdout=out)
+        mock_benchmark.assert_called_once_with(10, 5)
+        self.assertEqual(json.loads(out.getvalue()), {'recipients': 10})
+
+    @patch('eol_forum_notifications.benchmark.benchmark_save_load')
+    def test_command_discussion_notification_benchmark_save_load(self, mock_benchmark):
+        """
+        Test discussion_notification_benchmark save_load passes clients and requests
+        """
+        mock_benchmark.return_value = {'clients': 4, 'errors': 0}
+        out = StringIO()
+        call_command('discussion_notification_benchmark', 'save_load', '--clients', '4', '--requests', '10', stdout=out)
+        mock_benchmark.assert_called_once_with(4, 10)
+        self.assertEqual(json.loads(out.getvalue()), {'clients': 4, 'errors': 0})
+        self.assertEqual(benchmark.get_percentile([1, 2, 3, 4], 50), 3)
+        self.assertEqual(benchmark.get_percentile(list(range(100)), 99), 98)
+        self.assertIsNone(benchmark.get_percentile([], 50))
+
+    @patch('eol_forum_notifications.benchmark.benchmark_pipeline')
+    def test_command_discussion_notification_benchmark_pipeline(self, mock_benchmark):
+        """
+        Test discussion_notification_benchmark pipeline parses the scales
+        """
+        mock_benchmark.return_value = {'scales': []}
+        out = StringIO()
+        call_command('discussion_notification_benchmark', 'pipeline', '--scales', '1x2x3,4x5x6', stdout=out)
+        mock_benchmark.assert_called_once_with([(1, 2, 3), (4, 5, 6)])
+        self.assertEqual(json.loads(out.getvalue()), {'scales': []})
+        with self.assertRaises(CommandError):
+            call_command('discussion_notification_benchmark', 'pipeline', '--scales', '1x2', stdout=out)
+
+
+class TestMetrics(TestCase):
+
+    @override_settings(EOL_FORUM_NOTIFICATIONS_METRICS={'BACKEND': 'eol_forum_notifications.metrics.MemoryMetrics'})
+    def test_metrics_memory(self):
+        """
+        Test views, counter resets and reports send their metrics to the configured backend
+        """
+        metrics = get_metrics()
+        self.assertIsInstance(metrics, MemoryMetrics)
+        request = TestRequest()
+        request.method = 'POST'
+        request.user = AnonymousUser()
+        request.POST = {'period': 'daily', 'discussion_id': '1', 'course_id': 'course-v1:eol+test100+2021_1', 'user_id': '1'}
+        response = save_notification(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(metrics.counters['views.save_notification.400'], 1)
+        self.assertEqual(len(metrics.timings['views.save_notification']), 1)
+        discussion = EolForumNotificationsDiscussions.objects.create(
+            discussion_id="1234567890",
+            course_id=CourseKey.from_string('course-v1:eol+test100+2021_1'),
+            daily_threads=2)
+        reset_discussions_counters('daily', [{'id': discussion.id, 'daily_threads': 2, 'daily_comment': 0}])
+        self.assertEqual(metrics.counters['reset_counters.discussions'], 1)
+        self.assertEqual(len(metrics.timings['reset_counters']), 1)
+        report = NotificationReport()
+        report.incr('courses', 2)
+        with report.phase('get_courses_onlive'):
+            pass
+        report.send_metrics('send_notification.daily')
+        self.assertEqual(metrics.counters['send_notification.daily.courses'], 2)
+        self.assertEqual(len(metrics.timings['send_notification.daily.get_courses_onlive']), 1)
+
+    def test_metrics_statsd(self):
+        """
+        Test StatsdMetrics sends statsd lines over UDP and ignores socket errors
+        """
+        metrics = StatsdMetrics(host='statsd.test', port=8125, prefix='eol')
+        metrics.socket = MagicMock()
+        metrics.timing('email.smtp', 0.25)
+        metrics.incr('email.sent', 3)
+        self.assertEqual(metrics.socket.sendto.call_args_list[0][0], (b'eol.email.smtp:250|ms', ('statsd.test', 8125)))
+        self.assertEqual(metrics.socket.sendto.call_args_list[1][0], (b'eol.email.sent:3|c', ('statsd.test', 8125)))
+        metrics.socket.sendto.side_effect = OSError('unreachable')
+        metrics.incr('email.sent')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'eol_forum_notifications_dispatch'}})
+class TestDispatch(TestCase):
+
+    def setUp(self):
+        super(TestDispatch, self).setUp()
+        cache.clear()
+
+    @patch('eol_forum_notifications.dispatch.time')
+    def test_rate_limiter(self, time_mock):
+        """
+        Test RateLimiter shares the tokens of a window and waits for the next window when they are spent
+        """
+        clock = [125.0]
+        time_mock.time.side_effect = lambda: clock[0]
+        time_mock.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        self.assertEqual(RateLimiter(2).acquire(), 0)
+        self.assertEqual(RateLimiter(2).acquire(), 0)
+        self.assertEqual(RateLimiter(2).acquire(), 55)
+        time_mock.sleep.assert_called_once_with(55)
+        self.assertEqual(clock[0], 180)
+
+    @patch('eol_forum_notifications.dispatch.time')
+    def test_dispatch_scheduler(self, time_mock):
+        """
+        Test DispatchScheduler spreads the emails over the deadline and never faster than the rate
+        """
+        time_mock.monotonic.return_value = 1000.0
+        scheduler = DispatchScheduler(rate=60)
+        self.assertEqual([scheduler.countdown(10) for i in range(3)], [0, 10, 20])
+        scheduler = DispatchScheduler(deadline=100, total=20)
+        self.assertEqual([scheduler.countdown(10) for i in range(2)], [0, 50])
+        # the deadline allows 2 emails per second, the rate only 1
+        scheduler = DispatchScheduler(rate=60, deadline=100, total=200)
+        self.assertEqual([scheduler.countdown(10) for i in range(2)], [0, 10])
+        time_mock.monotonic.return_value = 1005.0
+        self.assertEqual(scheduler.countdown(10), 15)
+
+    @patch('eol_forum_notifications.dispatch.logger')
+    def test_dispatch_scheduler_warning(self, logger_mock):
+        """
+        Test DispatchScheduler only warns when the rate does not allow to send total emails in the deadline
+        """
+        # 11 * (100 / 11) is rounded above 100
+        DispatchScheduler(deadline=100, total=11)
+        DispatchScheduler(rate=120, deadline=100, total=200)
+        logger_mock.warning.assert_not_called()
+        DispatchScheduler(rate=60, deadline=100, total=200)
+        logger_mock.warning.assert_called_once()
+
+    @override_settings(EOL_FORUM_NOTIFICATIONS_EMAIL_RATE=1)
+    @patch('eol_forum_notifications.dispatch.time')
+    def test_task_send_bulk_email_rate_limit(self, time_mock):
+        """
+        Test task_send_bulk_email takes a token for each email
+        """
+        clock = [60.0]
+        time_mock.time.side_effect = lambda: clock[0]
+        time_mock.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        contexts = [benchmark.get_email_context(i) for i in range(2)]
+        self.assertEqual(task_send_bulk_email(contexts), 2)
+        self.assertEqual(len(mail.outbox), 2)
+        time_mock.sleep.assert_called_once_with(60)
@@ -3,7 +3,7 @@
 from django.conf.urls import url
 from django.conf import settings
 
-from .views import save_notification, save_notification_get, save_notification_post
+from .views import save_course_notification, save_notification, save_notification_get, save_notification_post
 
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
@@ -24,4 +24,9 @@ urlpatterns = (
         login_required(save_notification_post),
         name='save_post',
     ),
+    url(
+        r'^save_course/',
+        login_required(save_course_notification),
+        name='save_course',
+    ),
 )
@@ -5,127 +5,489 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from django.contrib.sites.shortcuts import get_current_site
-from django.db import transaction
+from django.db import connection, transaction
+from django.core.cache import cache
+from django.db.models import Case, F, FilteredRelation, Q, Value, When
 from django.http import HttpResponseRedirect, HttpResponseForbidden, Http404
 from django.shortcuts import render
 from django.urls import reverse
 from django.http import HttpResponse
 import openedx.core.djangoapps.django_comment_common.comment_client as cc
 from openedx.core.djangoapps.django_comment_common.utils import ThreadContext
-from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions
+from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions, NotificationRun, NotificationRunDiscussion
+from .metrics import incr, timer
 from lms.djangoapps.courseware.courses import get_course_by_id
+from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
 from openedx.core.lib.courses import course_image_url
 from opaque_keys.edx.keys import CourseKey
 from xmodule.modulestore.django import modulestore
 from django.utils.timezone import now
+from datetime import timedelta
+import hashlib
 import json
 import requests
+import sqlite3
 import logging
+import zlib
 
 logger = logging.getLogger(__name__)
+NOTIFICATIONS_CHUNK_SIZE = 500
+NOTIFICATIONS_RESUME_HOURS = 12
+USER_DISCUSSIONS_TIMEOUT = 60 * 60
+BLOCK_COURSE_TIMEOUT = 60 * 60
 
 
-def get_users_notifications(how_often, discussion_id, course_id):
+def get_activity_filter(how_often):
     """
-        return all user based on params
+        return Q filter of discussions with threads and/or comments in the period
+        (indexed pending flag)
     """
-    notifications = []
-    course_key = CourseKey.from_string(course_id)
-    discussion = EolForumNotificationsDiscussions.objects.get(discussion_id=discussion_id, course_id=course_key)
     if how_often == 'daily':
-        if discussion.daily_threads > 0 or discussion.daily_comment > 0:
-            notifications = EolForumNotificationsUser.objects.filter(
-                how_often=how_often, 
-                discussion__discussion_id=discussion_id, 
-                discussion__course_id=course_key).values(
-                    'user__id',
-                    'user__email'
-                )
-    else:
-        #weekly
-        if discussion.weekly_threads > 0 or discussion.weekly_comment > 0:
-            notifications = EolForumNotificationsUser.objects.filter(
-                how_often=how_often, 
-                discussion__discussion_id=discussion_id, 
-                discussion__course_id=course_key).values(
-                    'user__id',
-                    'user__email'
-                )
-    return list(notifications)
-
-def get_courses_onlive():
-    """
-        get all courses onlive (not archived)
-    """
-    courses = EolForumNotificationsDiscussions.objects.all().values('course_id').distinct()
-    course_data = {}
-    for c in courses:
-        aux = get_course_by_id(c['course_id'])
-        if aux.end is None or now() <= aux.end:
-            course_data[str(c['course_id'])] = {
+        return Q(daily_pending=True)
+    #weekly
+    return Q(weekly_pending=True)
+
+def count_pending_subscribers(how_often):
+    """
+        return the users subscribed in the period to discussions with pending activity
+        of courses not ended, the expected emails of a run
+    """
+    return EolForumNotificationsUser.objects.filter(
+        how_often=how_often,
+        discussion__in=EolForumNotificationsDiscussions.objects.filter(get_activity_filter(how_often), get_course_live_filter())).count()
+
+def get_notifications_chunk_size():
+    """
+        return how many rows are read by each query of the notification run
+    """
+    return getattr(settings, 'EOL_FORUM_NOTIFICATIONS_CHUNK_SIZE', NOTIFICATIONS_CHUNK_SIZE)
+
+def get_discussions_users_notifications(how_often, discussion_ids, chunk_size=NOTIFICATIONS_CHUNK_SIZE):
+    """
+        yield the users subscribed in the period to the discussions (primary keys),
+        paginated by EolForumNotificationsUser id
+    """
+    last_id = 0
+    while discussion_ids:
+        users = list(EolForumNotificationsUser.objects.filter(
+            how_often=how_often,
+            discussion__in=discussion_ids,
+            id__gt=last_id).order_by('id').values(
+                'id',
+                'discussion_id',
+                'user__id',
+                'user__email'
+            )[:chunk_size])
+        for user in users:
+            yield user
+        if len(users) < chunk_size:
+            return
+        last_id = users[-1]['id']
+
+def get_courses_metadata(course_keys):
+    """
+        return name, end date and image of the courses, read in bulk from CourseOverview,
+        the modulestore is only used for courses without overview
+    """
+    courses = {}
+    for overview in CourseOverview.objects.filter(id__in=course_keys):
+        courses[str(overview.id)] = {
+            'course_name': overview.display_name_with_default,
+            'end': overview.end,
+            'image': overview.course_image_url
+        }
+    for course_key in course_keys:
+        if str(course_key) not in courses:
+            aux = get_course_by_id(course_key)
+            courses[str(course_key)] = {
                 'course_name': aux.display_name_with_default,
-                'image': course_image_url(aux),
-                'discussions': list(EolForumNotificationsDiscussions.objects.filter(course_id=c['course_id']).values(
-                    'discussion_id',
-                    'block_key',
-                    'daily_threads',
-                    'daily_comment',
-                    'weekly_threads',
-                    'weekly_comment'
-                    ))
+                'end': aux.end,
+                'image': course_image_url(aux)
             }
-    return course_data
+    return courses
+
+def get_course_shard(course_id, shards):
+    """
+        return the shard (0 to shards - 1) of the course, stable between processes and hosts
+    """
+    return zlib.crc32(str(course_id).encode('utf-8')) % shards
+
+def get_course_live_filter():
+    """
+        return Q filter of discussions of courses not ended (or with unknown end date)
+    """
+    return Q(course_end__isnull=True) | Q(course_end__gt=now())
+
+def update_course_end(course_key, end):
+    """
+        save the end date of the course in its discussions
+    """
+    return EolForumNotificationsDiscussions.objects.filter(course_id=course_key).update(course_end=end)
+
+def refresh_courses_end(chunk_size=NOTIFICATIONS_CHUNK_SIZE, shards=1, shard_index=0):
+    """
+        save the CourseOverview end date in the discussions of the courses saved as ended,
+        so courses extended after they ended are notified again.
+        With shards only the courses of shard_index are refreshed. Return the number of courses updated
+    """
+    updated = 0
+    last_course = None
+    while True:
+        courses = EolForumNotificationsDiscussions.objects.filter(course_end__lte=now())
+        if last_course is not None:
+            courses = courses.filter(course_id__gt=last_course)
+        courses = list(courses.values_list('course_id', 'course_end').distinct().order_by('course_id')[:chunk_size])
+        ends = {course_key: end for course_key, end in courses if get_course_shard(course_key, shards) == shard_index}
+        for course_key, end in CourseOverview.objects.filter(id__in=list(ends)).values_list('id', 'end'):
+            if end != ends[course_key]:
+                update_course_end(course_key, end)
+                updated += 1
+        if len(courses) < chunk_size:
+            return updated
+        last_course = courses[-1][0]
+
+def get_courses_onlive(chunk_size=NOTIFICATIONS_CHUNK_SIZE, shards=1, shard_index=0, how_often=None, dry_run=False):
+    """
+        yield all courses onlive (not archived) with discussions, as (course_id, course data),
+        reading chunk_size courses at a time. With shards only the courses of shard_index are returned,
+        with how_often only the courses with pending activity in the period.
+        Ended courses are filtered by the course_end of the discussions, the end date of
+        the courses loaded here is saved so they are not loaded again (not with dry_run)
+    """
+    last_course = None
+    while True:
+        courses = EolForumNotificationsDiscussions.objects.filter(get_course_live_filter())
+        if how_often is not None:
+            courses = courses.filter(get_activity_filter(how_often))
+        courses = courses.values_list('course_id', flat=True).distinct().order_by('course_id')
+        if last_course is not None:
+            courses = courses.filter(course_id__gt=last_course)
+        courses = list(courses[:chunk_size])
+        shard_courses = [course_key for course_key in courses if get_course_shard(course_key, shards) == shard_index]
+        courses_metadata = get_courses_metadata(shard_courses)
+        for course_key in shard_courses:
+            aux = courses_metadata[str(course_key)]
+            if aux['end'] is None or now() <= aux['end']:
+                yield str(course_key), {
+                    'course_name': aux['course_name'],
+                    'image': aux['image']
+                }
+            elif not dry_run:
+                update_course_end(course_key, aux['end'])
+        if len(courses) < chunk_size:
+            return
+        last_course = courses[-1]
+
+def get_discussions_onlive(course_id, how_often, chunk_size=NOTIFICATIONS_CHUNK_SIZE, run=None):
+    """
+        yield lists of up to chunk_size discussions of the course with threads and/or comments in the period,
+        skipping the discussions already notified by run
+    """
+    last_id = 0
+    while True:
+        discussions = EolForumNotificationsDiscussions.objects.filter(
+            get_activity_filter(how_often),
+            course_id=CourseKey.from_string(course_id),
+            id__gt=last_id)
+        if run is not None:
+            discussions = discussions.exclude(id__in=NotificationRunDiscussion.objects.filter(run=run).values('discussion_id'))
+        discussions = list(discussions.order_by('id').values(
+                'id',
+                'discussion_id',
+                'block_key',
+                'daily_threads',
+                'daily_comment',
+                'weekly_threads',
+                'weekly_comment'
+            )[:chunk_size])
+        if discussions:
+            yield discussions
+        if len(discussions) < chunk_size:
+            return
+        last_id = discussions[-1]['id']
+
+def reset_discussions_counters(how_often, discussions):
+    """
+        subtract the notified threads/comments from the discussions counters, so activity
+        posted after the counts were read is kept, and clear the pending flag of the discussions
+        without new activity. Discussions with the same counts are updated in a single UPDATE
+    """
+    threads = '{}_threads'.format(how_often)
+    comment = '{}_comment'.format(how_often)
+    pending = '{}_pending'.format(how_often)
+    counts = {}
+    for discussion in discussions:
+        if discussion[threads] > 0 or discussion[comment] > 0:
+            counts.setdefault((discussion[threads], discussion[comment]), []).append(discussion['id'])
+    with timer('reset_counters'):
+        for (threads_count, comment_count), ids in counts.items():
+            # pending goes first, MySQL evaluates SET assignments in order with the updated values
+            EolForumNotificationsDiscussions.objects.filter(id__in=ids).update(**{
+                pending: Case(
+                    When(Q(**{'{}__gt'.format(threads): threads_count}) | Q(**{'{}__gt'.format(comment): comment_count}), then=Value(True)),
+                    default=Value(False),
+                    output_field=EolForumNotificationsDiscussions._meta.get_field(pending)),
+                threads: F(threads) - threads_count,
+                comment: F(comment) - comment_count
+            })
+    incr('reset_counters.discussions', sum(len(ids) for ids in counts.values()))
+    return len(counts)
+
+def get_notification_run(how_often, digest=False, shards=1, shard_index=0):
+    """
+        return the unfinished run with the same parameters started in the last
+        EOL_FORUM_NOTIFICATIONS_RESUME_HOURS hours, or a new run
+    """
+    resume_hours = getattr(settings, 'EOL_FORUM_NOTIFICATIONS_RESUME_HOURS', NOTIFICATIONS_RESUME_HOURS)
+    run = NotificationRun.objects.filter(
+        how_often=how_often,
+        digest=digest,
+        shards=shards,
+        shard_index=shard_index,
+        finished_at__isnull=True,
+        started_at__gte=now() - timedelta(hours=resume_hours)).order_by('-id').first()
+    if run is not None:
+        logger.info('EolForumNotification - Resuming run {}, how_often: {}'.format(run.id, how_often))
+        return run
+    return NotificationRun.objects.create(how_often=how_often, digest=digest, shards=shards, shard_index=shard_index)
+
+def save_notified_discussions(run, how_often, discussions):
+    """
+        reset the counters of the notified discussions and save them in the run ledger, in one transaction
+    """
+    with transaction.atomic():
+        reset_discussions_counters(how_often, discussions)
+        NotificationRunDiscussion.objects.bulk_create([
+            NotificationRunDiscussion(run=run, discussion_id=discussion['id']) for discussion in discussions
+        ])
+
+def finish_notification_run(run, chunk_size=NOTIFICATIONS_CHUNK_SIZE):
+    """
+        mark the run as finished and delete its ledger, only read to resume unfinished runs
+    """
+    run.finished_at = now()
+    run.save()
+    return delete_run_ledger(run.id, chunk_size)
+
+def delete_run_ledger(run_id, chunk_size=NOTIFICATIONS_CHUNK_SIZE):
+    """
+        delete the NotificationRunDiscussion rows of the run in keyset chunks, return the number of rows
+    """
+    count = 0
+    last_id = 0
+    while True:
+        ids = list(NotificationRunDiscussion.objects.filter(run_id=run_id, id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if ids:
+            NotificationRunDiscussion.objects.filter(id__in=ids).delete()
+            count += len(ids)
+        if len(ids) < chunk_size:
+            return count
+        last_id = ids[-1]
+
+def get_user_discussions_key(user_id, course_key):
+    """
+        return cache key of the discussions map of the user in the course
+    """
+    course_hash = hashlib.md5(str(course_key).encode('utf-8')).hexdigest()
+    return 'eol_forum_notifications:user_discussions:{}:{}'.format(user_id, course_hash)
+
+def get_user_discussions(user, course_key):
+    """
+        return {discussion_id: how_often} of every discussion of the course, how_often is None
+        if the user has no notification model. Loaded with one query and cached
+    """
+    key = get_user_discussions_key(user.id, course_key)
+    discussions = cache.get(key)
+    if discussions is None:
+        discussions = dict(EolForumNotificationsDiscussions.objects.filter(
+            course_id=course_key
+        ).annotate(
+            user_notification=FilteredRelation('eolforumnotificationsuser', condition=Q(eolforumnotificationsuser__user=user))
+        ).values_list('discussion_id', 'user_notification__how_often'))
+        cache.set(key, discussions, USER_DISCUSSIONS_TIMEOUT)
+    return discussions
+
+def invalidate_user_discussions(user, course_key):
+    """
+        remove the cached discussions map of the user in the course
+    """
+    cache.delete(get_user_discussions_key(user.id, course_key))
 
 def get_user_data(discussion_id, user, course_key, block_key):
     """
         return user notification data
     """
-    if EolForumNotificationsDiscussions.objects.filter(discussion_id=discussion_id, course_id=course_key).exists():
-        try:
-            aux = EolForumNotificationsUser.objects.get(discussion__discussion_id=discussion_id, user=user, discussion__course_id=course_key)
-            return json.dumps({
-                'how_often': aux.how_often
+    discussions = get_user_discussions(user, course_key)
+    if discussion_id not in discussions:
+        EolForumNotificationsDiscussions.objects.get_or_create(discussion_id=discussion_id, course_id=course_key, defaults={'block_key': block_key})
+        # the map was read before the insert, a save view may have changed it since
+        invalidate_user_discussions(user, course_key)
+        return '{}'
+    if discussions[discussion_id] is None:
+        logger.info('EolForumNotification - Error to get notif model, discussion {}, user: {}'.format(discussion_id, user))
+        return '{}'
+    return json.dumps({
+        'how_often': discussions[discussion_id]
+    })
+
+def get_users_data(discussions, user, course_key):
+    """
+        return {discussion_id: user notification data} of a list of (discussion_id, block_key),
+        missing discussions are created with one bulk_create, so the queries do not depend on
+        the number of discussions. The cached map is reloaded by the next call after an insert
+    """
+    user_discussions = get_user_discussions(user, course_key)
+    missing = {discussion_id: block_key for discussion_id, block_key in discussions if discussion_id not in user_discussions}
+    if missing:
+        EolForumNotificationsDiscussions.objects.bulk_create([
+            EolForumNotificationsDiscussions(discussion_id=discussion_id, course_id=course_key, block_key=block_key)
+            for discussion_id, block_key in missing.items()
+        ], ignore_conflicts=True)
+        # the map was read before the insert, a save view may have changed it since
+        invalidate_user_discussions(user, course_key)
+        user_discussions = dict(user_discussions, **dict.fromkeys(missing))
+    data = {}
+    for discussion_id, block_key in discussions:
+        if user_discussions[discussion_id] is None:
+            data[discussion_id] = '{}'
+        else:
+            data[discussion_id] = json.dumps({
+                'how_often': user_discussions[discussion_id]
             })
-        except EolForumNotificationsUser.DoesNotExist:
-            logger.info('EolForumNotification - Error to get notif model, discussion {}, user: {}'.format(discussion_id, user))
-            return '{}'
+    return data
+
+def save_course_notifications(user, course_key, how_often, discussion_ids=None):
+    """
+        set how_often of the user in every discussion of the course (or only discussion_ids),
+        return the number of discussions. Django < 4.1 has no bulk_create(update_conflicts),
+        so missing models are inserted ignoring conflicts and the existing ones are updated
+    """
+    discussions = EolForumNotificationsDiscussions.objects.filter(course_id=course_key)
+    if discussion_ids is not None:
+        discussions = discussions.filter(discussion_id__in=discussion_ids)
+    ids = list(discussions.values_list('id', flat=True))
+    if ids:
+        with transaction.atomic():
+            EolForumNotificationsUser.objects.bulk_create([
+                EolForumNotificationsUser(user=user, discussion_id=discussion_id, how_often=how_often) for discussion_id in ids
+            ], ignore_conflicts=True)
+            EolForumNotificationsUser.objects.filter(user=user, discussion_id__in=ids).exclude(how_often=how_often).update(how_often=how_often)
+    invalidate_user_discussions(user, course_key)
+    return len(ids)
+
+def upsert_user_notification(user_id, discussion_id, course_key, how_often):
+    """
+        insert or update how_often of the user in the discussion with a single statement
+        (INSERT ... SELECT with ON CONFLICT or ON DUPLICATE KEY), return False if the
+        discussion doesn't exist. Other databases use update_or_create
+    """
+    discussions_table = EolForumNotificationsDiscussions._meta.db_table
+    users_table = EolForumNotificationsUser._meta.db_table
+    insert = (
+        'INSERT INTO {users} (user_id, discussion_id, how_often) '
+        'SELECT %s, id, %s FROM {discussions} WHERE discussion_id = %s AND course_id = %s '
+    ).format(users=users_table, discussions=discussions_table)
+    if connection.vendor == 'mysql':
+        sql = insert + 'ON DUPLICATE KEY UPDATE how_often = %s'
+    elif connection.vendor == 'postgresql' or (connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24)):
+        sql = insert + 'ON CONFLICT (discussion_id, user_id) DO UPDATE SET how_often = %s'
     else:
-        EolForumNotificationsDiscussions.objects.create(discussion_id=discussion_id, course_id=course_key, block_key=block_key)
-        return '{}'
+        with transaction.atomic():
+            try:
+                discussion = EolForumNotificationsDiscussions.objects.get(discussion_id=discussion_id, course_id=course_key)
+            except EolForumNotificationsDiscussions.DoesNotExist:
+                return False
+            EolForumNotificationsUser.objects.update_or_create(user_id=user_id, discussion=discussion, defaults={'how_often': how_often})
+        return True
+    with connection.cursor() as cursor:
+        how_often = EolForumNotificationsUser._meta.get_field('how_often').get_prep_value(how_often)
+        cursor.execute(sql, [user_id, how_often, discussion_id, str(course_key), how_often])
+        return cursor.rowcount > 0
 
 def get_block_info(block_key):
     """
         get displat name and parent id from block_key
     """
     store = modulestore()
-    default = 'Discusión'
     try:
         with store.bulk_operations(block_key.course_key):
+            return _get_block_data(store, block_key)
+    except Exception as e:
+        logger.info('EolForumNotification - Error to get block data, block id: {}'.format(block_key))
+        return _get_block_data(None, None)
+
+def get_blocks_info(block_keys, cache=None):
+    """
+        get display name and parent id of many blocks, reading each course
+        inside one bulk operation. Results are kept in cache (dict by block_key)
+    """
+    if cache is None:
+        cache = {}
+    store = modulestore()
+    courses = {}
+    for block_key in block_keys:
+        if str(block_key) in cache:
+            continue
+        if block_key is None:
+            cache[str(block_key)] = _get_block_data(None, None)
+            continue
+        courses.setdefault(block_key.course_key, []).append(block_key)
+    for course_key, course_block_keys in courses.items():
+        try:
+            with store.bulk_operations(course_key):
+                for block_key in course_block_keys:
+                    cache[str(block_key)] = _get_block_data(store, block_key)
+        except Exception as e:
+            logger.info('EolForumNotification - Error to get blocks data, course id: {}'.format(course_key))
+            for block_key in course_block_keys:
+                cache.setdefault(str(block_key), _get_block_data(None, None))
+    return {str(block_key): cache[str(block_key)] for block_key in block_keys}
+
+def _get_block_data(store, block_key):
+    """
+        get display name and parent id of a block, with default values if block doesnt exists
+    """
+    default = 'Discusión'
+    if store is not None:
+        try:
             block = store.get_item(block_key)
             return {
                 'display_name': block.display_name or default,
                 'parent': str(block.parent)
             }
-    except Exception as e:
-        logger.info('EolForumNotification - Error to get block data, block id: {}'.format(block_key))
-        return {
-                'display_name': default,
-                'parent': ''
-            }
+        except Exception as e:
+            logger.info('EolForumNotification - Error to get block data, block id: {}'.format(block_key))
+    return {
+            'display_name': default,
+            'parent': ''
+        }
 
-def get_info_block_course(discussion_id, course_id):
+def get_info_block_course(discussion_id, course_id, discussion=None):
     """
-        get course and discussion display_name
+        get course and discussion display_name, cached per course and discussion
+        for EOL_FORUM_NOTIFICATIONS_BLOCK_COURSE_TIMEOUT seconds or until the CourseOverview
+        of the course is modified (it is updated on every publish)
     """
     try:
         course_key = CourseKey.from_string(course_id)
-        discussion = EolForumNotificationsDiscussions.objects.get(discussion_id=discussion_id, course_id=course_key)
+        modified = CourseOverview.objects.filter(id=course_key).values_list('modified', flat=True).first()
+        key = 'eol_forum_notifications:block_course:{}:{}:{}'.format(
+            modified.timestamp() if modified is not None else '',
+            hashlib.md5(str(course_key).encode('utf-8')).hexdigest(),
+            hashlib.md5(str(discussion_id).encode('utf-8')).hexdigest())
+        data = cache.get(key)
+        if data is not None:
+            return data
+        if discussion is None:
+            discussion = EolForumNotificationsDiscussions.objects.get(discussion_id=discussion_id, course_id=course_key)
         block_info = get_block_info(discussion.block_key)
         course = get_course_by_id(course_key)
-        return {
+        data = {
             'course_name': course.display_name_with_default,
             'discussion_name': block_info['display_name']
         }
+        cache.set(key, data, getattr(settings, 'EOL_FORUM_NOTIFICATIONS_BLOCK_COURSE_TIMEOUT', BLOCK_COURSE_TIMEOUT))
+        return data
     except Exception as e:
         logger.info('EolForumNotification - Error to get block and course data, course id: {}, discussion_id: {}'.format(course_id, discussion_id))
         return None
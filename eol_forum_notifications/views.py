@@ -8,9 +8,9 @@ import uuid
 # Installed packages (via pip)
 from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
-from django.db import transaction
 from django.http import HttpResponse
 from django.http import HttpResponseNotFound
+from django.http import JsonResponse
 from django.shortcuts import render
 from django.urls import reverse
 
@@ -18,12 +18,32 @@ from django.urls import reverse
 from opaque_keys.edx.keys import CourseKey
 
 # Internal project dependencies
+from .activity import flush_activity
+from .dispatch import DispatchScheduler, get_email_rate, get_send_deadline
+from .metrics import timed
 from .models import EolForumNotificationsUser, EolForumNotificationsDiscussions
-from .utils import get_users_notifications, get_courses_onlive, get_block_info, get_info_block_course
+from .report import NotificationReport
+from .utils import (
+    count_pending_subscribers,
+    finish_notification_run,
+    get_blocks_info,
+    get_courses_onlive,
+    get_discussions_onlive,
+    get_discussions_users_notifications,
+    get_info_block_course,
+    get_notification_run,
+    get_notifications_chunk_size,
+    invalidate_user_discussions,
+    refresh_courses_end,
+    save_course_notifications,
+    save_notified_discussions,
+    upsert_user_notification
+)
 
 logger = logging.getLogger(__name__)
 msg_error = "contáctese al correo eol-ayuda@uchile.cl adjuntando el número del error"
 
+@timed('views.save_notification_get')
 def save_notification_get(request):
     """
         Save notifications page GET
@@ -44,10 +64,10 @@ def save_notification_get(request):
 
     try:
         course_id = CourseKey.from_string(request.GET.get('course_id'))
-        discussion = EolForumNotificationsDiscussions.objects.get(discussion_id=request.GET.get('discussion_id'), course_id=course_id)
-        user_notif = EolForumNotificationsUser.objects.get(
+        user_notif = EolForumNotificationsUser.objects.select_related('discussion').get(
             user=request.user,
-            discussion=discussion)
+            discussion__discussion_id=request.GET.get('discussion_id'),
+            discussion__course_id=course_id)
         context = {
             'discussion_id': request.GET.get('discussion_id'),
             'course_id':request.GET.get('course_id'),
@@ -55,7 +75,7 @@ def save_notification_get(request):
             'period': user_notif.how_often,
             'save_btn': True
         }
-        data = get_info_block_course(request.GET.get('discussion_id'),request.GET.get('course_id'))
+        data = get_info_block_course(request.GET.get('discussion_id'),request.GET.get('course_id'), user_notif.discussion)
         if data:
             context.update(data)
         return render(request, 'eol_forum_notifications/notification.html', context)
@@ -64,6 +84,7 @@ def save_notification_get(request):
         return HttpResponseNotFound('(Error {} ) Error con el modelo, por favor {}'.format(id_error, msg_error))
 
 
+@timed('views.save_notification_post')
 def save_notification_post(request):
     """
         Save notifications page POST
@@ -84,32 +105,28 @@ def save_notification_post(request):
     if request.POST.get('period') not in ['never', 'daily', 'weekly']:
         logger.error('EolForumNotification - Period not in (never, weekly, daily), Data: {}'.format(request.POST))
         return render(request, 'eol_forum_notifications/notification.html', {'error': '(Error {} ) Error con el parametro periodo, por favor {}'.format(id_error, msg_error)})
-    with transaction.atomic():
-        try:
-            course_id = CourseKey.from_string(request.POST.get('course_id'))
-            discussion = EolForumNotificationsDiscussions.objects.get(discussion_id=request.POST.get('discussion_id'), course_id=course_id)
-            EolForumNotificationsUser.objects.update_or_create(
-                user=request.user,
-                discussion=discussion,
-                defaults={
-                    'how_often': request.POST.get('period')
-                    })
-            context = {
-                'discussion_id': request.POST.get('discussion_id'),
-                'course_id':request.POST.get('course_id'),
-                'user_id':request.POST.get('user_id'),
-                'period': request.POST.get('period'),
-                'save': True,
-                'save_btn': True
-            }
-            data = get_info_block_course(request.POST.get('discussion_id'),request.POST.get('course_id'))
-            if data:
-                context.update(data)
-            return render(request, 'eol_forum_notifications/notification.html', context)
-        except Exception as e:
-            logger.error('EolForumNotification - Error to update or create EolForumNotificationsUser, error {}, data: {}'.format(str(e), request.POST))
-            return render(request, 'eol_forum_notifications/notification.html', {'error': '(Error {} ) Un error inesperado ha ocurrido, por favor {}'.format(id_error, msg_error)})
+    try:
+        course_id = CourseKey.from_string(request.POST.get('course_id'))
+        if not upsert_user_notification(request.user.id, request.POST.get('discussion_id'), course_id, request.POST.get('period')):
+            raise EolForumNotificationsDiscussions.DoesNotExist('EolForumNotificationsDiscussions matching query does not exist.')
+        invalidate_user_discussions(request.user, course_id)
+        context = {
+            'discussion_id': request.POST.get('discussion_id'),
+            'course_id':request.POST.get('course_id'),
+            'user_id':request.POST.get('user_id'),
+            'period': request.POST.get('period'),
+            'save': True,
+            'save_btn': True
+        }
+        data = get_info_block_course(request.POST.get('discussion_id'),request.POST.get('course_id'))
+        if data:
+            context.update(data)
+        return render(request, 'eol_forum_notifications/notification.html', context)
+    except Exception as e:
+        logger.error('EolForumNotification - Error to update or create EolForumNotificationsUser, error {}, data: {}'.format(str(e), request.POST))
+        return render(request, 'eol_forum_notifications/notification.html', {'error': '(Error {} ) Un error inesperado ha ocurrido, por favor {}'.format(id_error, msg_error)})
 
+@timed('views.save_notification')
 def save_notification(request):
     """
         Save notifications on forum xblock
@@ -129,26 +146,82 @@ def save_notification(request):
     if request.POST.get('period') not in ['never', 'daily', 'weekly']:
         logger.error('EolForumNotification - Period not in (never, weekly, daily), Data: {}'.format(request.POST))
         return HttpResponse(status=400)
-    with transaction.atomic():
-        try:
-            course_id = CourseKey.from_string(request.POST.get('course_id'))
-            discussion = EolForumNotificationsDiscussions.objects.get(discussion_id=request.POST.get('discussion_id'), course_id=course_id)
-            EolForumNotificationsUser.objects.update_or_create(
-                user=request.user,
-                discussion=discussion,
-                defaults={
-                    'how_often': request.POST.get('period')
-                    })
-            return HttpResponse(status=200)
-        except Exception as e:
-            logger.error('EolForumNotification - Error to update or create EolForumNotificationsUser, error {}, data: {}'.format(str(e), request.POST))
-            return HttpResponse(status=400)
+    try:
+        course_id = CourseKey.from_string(request.POST.get('course_id'))
+        if not upsert_user_notification(request.user.id, request.POST.get('discussion_id'), course_id, request.POST.get('period')):
+            raise EolForumNotificationsDiscussions.DoesNotExist('EolForumNotificationsDiscussions matching query does not exist.')
+        invalidate_user_discussions(request.user, course_id)
+        return HttpResponse(status=200)
+    except Exception as e:
+        logger.error('EolForumNotification - Error to update or create EolForumNotificationsUser, error {}, data: {}'.format(str(e), request.POST))
+        return HttpResponse(status=400)
 
-def send_notification(how_often):
+@timed('views.save_course_notification')
+def save_course_notification(request):
     """
-        Send email with threads and/or comments unreaded
+        Save notifications of every discussion of the course,
+        or only the discussions in discussion_ids
     """
-    from .tasks import task_send_single_email
+    if request.method != "POST":
+        logger.error('EolForumNotification - Wrong Method: {}, only POST'.format(request.method))
+        return HttpResponse(status=400)
+    if 'period' not in request.POST or 'course_id' not in request.POST or 'user_id' not in request.POST:
+        logger.error('EolForumNotification - Missing Data: {}'.format(request.POST))
+        return HttpResponse(status=400)
+    if request.user.is_anonymous:
+        logger.error('EolForumNotification - User is anonymous, data: {}'.format(request.POST))
+        return HttpResponse(status=400)
+    if request.POST.get('user_id') != str(request.user.id):
+        logger.error('EolForumNotification - User Ids are differents, user id post: {}, user id resquest: {}'.format(request.POST.get('user_id'), request.user.id))
+        return HttpResponse(status=400)
+    if request.POST.get('period') not in ['never', 'daily', 'weekly']:
+        logger.error('EolForumNotification - Period not in (never, weekly, daily), Data: {}'.format(request.POST))
+        return HttpResponse(status=400)
+    try:
+        course_id = CourseKey.from_string(request.POST.get('course_id'))
+        discussion_ids = request.POST.getlist('discussion_ids') or None
+        discussions = save_course_notifications(request.user, course_id, request.POST.get('period'), discussion_ids)
+        return JsonResponse({'discussions': discussions})
+    except Exception as e:
+        logger.error('EolForumNotification - Error to save course EolForumNotificationsUser, error {}, data: {}'.format(str(e), request.POST))
+        return HttpResponse(status=400)
+
+def send_notification(how_often, digest=False, shards=1, shard_index=0, dry_run=False, report=None, deadline=None):
+    """
+        Send email with threads and/or comments unreaded,
+        with digest a single email is sent to each user with all his discussions.
+        Courses, discussions and subscribers are streamed in chunks of
+        EOL_FORUM_NOTIFICATIONS_CHUNK_SIZE, digest mode keeps one context per user.
+        With shards only the courses of shard_index (see get_course_shard) are processed.
+        With dry_run the whole run is done without enqueuing emails nor resetting counters.
+        Counters and phase timings are sent to the metrics backend (see metrics.py).
+        Email chunks are enqueued with countdowns spreading them over deadline seconds
+        (EOL_FORUM_NOTIFICATIONS_SEND_DEADLINE) at most at EOL_FORUM_NOTIFICATIONS_EMAIL_RATE (see dispatch.py).
+        Return the NotificationReport of the run
+    """
+    from .tasks import task_send_bulk_email, get_email_chunk_size
+    if report is None:
+        report = NotificationReport()
+    if deadline is None:
+        deadline = get_send_deadline()
+    # every shard sends its part of the emails at its part of the rate
+    rate = get_email_rate()
+    if rate:
+        rate = float(rate) / shards
+
+    def enqueue(contexts):
+        """
+            enqueue a chunk of email contexts, only counted on dry_run
+        """
+        report.incr('emails_enqueued', len(contexts))
+        if not dry_run:
+            with report.phase('task_enqueue'):
+                countdown = dispatch.countdown(len(contexts))
+                if countdown:
+                    task_send_bulk_email.apply_async(args=[contexts], countdown=countdown)
+                else:
+                    task_send_bulk_email.delay(contexts)
+
     try:
         current_site = get_current_site()
         platform_name =  current_site.configuration.get_value('PLATFORM_NAME', settings.PLATFORM_NAME)
@@ -157,48 +230,115 @@ def send_notification(how_often):
         logger.error('EolForumNotification - Error to get platform name and url site')
         platform_name =  settings.PLATFORM_NAME
         url_site = settings.LMS_ROOT_URL
-    courses_data = get_courses_onlive()
-    for course in courses_data:
-        for discussion in courses_data[course]['discussions']:
-            users_notifications = get_users_notifications(how_often, discussion['discussion_id'], course)
-            block = get_block_info(discussion['block_key'])
-            if block['parent'] == "":
-                logger.info('EolForumNotification - Block id doesnt exists, {}, course: {}'.format(discussion['block_key'], course))
-                continue
-            for user in users_notifications:
-                context = {
-                    'user_id':user['user__id'],
-                    'email': user['user__email'],
-                    'course_name': courses_data[course]['course_name'],
-                    'image': courses_data[course]['image'],
-                    'platform_name': platform_name,
-                    'url_site': url_site,
-                    'how_often': how_often,
-                    'discussion_name': block['display_name'],
-                    'parent': block['parent'],
-                    'course_id': course,
-                    'notif_url': '{}{}?{}'.format(
-                        url_site,
-                        reverse('eol_discussion_notification:save_get'),
-                        urlencode({
-                            'course_id': course,
-                            'user_id':user['user__id'],
-                            'discussion_id': discussion['discussion_id'],
+    with report.phase('total'):
+        if not dry_run:
+            with report.phase('flush_activity'):
+                flush_activity()
+            with report.phase('refresh_courses_end'):
+                refresh_courses_end(get_notifications_chunk_size(), shards, shard_index)
+        chunk_size = get_notifications_chunk_size()
+        email_chunk_size = get_email_chunk_size()
+        save_url = '{}{}'.format(url_site, reverse('eol_discussion_notification:save_get'))
+        run = None if dry_run else get_notification_run(how_often, digest, shards, shard_index)
+        total = None
+        if deadline and not digest and not dry_run:
+            with report.phase('count_subscribers'):
+                total = count_pending_subscribers(how_often) // shards + 1
+        dispatch = DispatchScheduler(rate, deadline, total)
+        digests = {}
+        digest_discussions = []
+        pending = []
+        for course, course_data in report.iterate('get_courses_onlive', get_courses_onlive(chunk_size, shards, shard_index, how_often, dry_run)):
+            report.incr('courses')
+            blocks_cache = {}
+            for discussions in report.iterate('get_discussions_onlive', get_discussions_onlive(course, how_often, chunk_size, run)):
+                report.incr('discussions', len(discussions))
+                with report.phase('get_block_info'):
+                    blocks = get_blocks_info([discussion['block_key'] for discussion in discussions], blocks_cache)
+                notified = {}
+                missing = []
+                for discussion in discussions:
+                    if blocks[str(discussion['block_key'])]['parent'] == "":
+                        logger.info('EolForumNotification - Block id doesnt exists, {}, course: {}'.format(discussion['block_key'], course))
+                        # saved with the notified discussions so the next runs do not load them again
+                        missing.append(discussion)
+                        continue
+                    notified[discussion['id']] = discussion
+                for user in report.iterate('get_users_notifications', get_discussions_users_notifications(how_often, list(notified), chunk_size)):
+                    report.incr('recipients')
+                    discussion = notified[user['discussion_id']]
+                    block = blocks[str(discussion['block_key'])]
+                    context = {
+                        'user_id':user['user__id'],
+                        'email': user['user__email'],
+                        'course_name': course_data['course_name'],
+                        'image': course_data['image'],
+                        'platform_name': platform_name,
+                        'url_site': url_site,
+                        'how_often': how_often,
+                        'discussion_name': block['display_name'],
+                        'parent': block['parent'],
+                        'course_id': course,
+                        'notif_url': '{}?{}'.format(
+                            save_url,
+                            urlencode({
+                                'course_id': course,
+                                'user_id':user['user__id'],
+                                'discussion_id': discussion['discussion_id'],
+                            })
+                        )
+                    }
+                    context.update(discussion)
+                    context.pop('block_key')
+                    context.pop('id')
+                    if run is not None:
+                        context['idempotency_key'] = '{}:{}:{}'.format(run.id, discussion['id'], user['user__id'])
+                    if digest:
+                        digest_context = digests.setdefault(user['user__id'], {
+                            'user_id': user['user__id'],
+                            'email': user['user__email'],
+                            'platform_name': platform_name,
+                            'url_site': url_site,
+                            'how_often': how_often,
+                            'discussions': []
                         })
-                    )
-                }
-                context.update(discussion)
-                context.pop('block_key')
-                task_send_single_email.delay(discussion['discussion_id'], course, context)
-            logger.info('EolForumNotification - emails sent, how_often: {}'.format(how_often))
-            with transaction.atomic():
-                discussion_model = EolForumNotificationsDiscussions.objects.get(discussion_id=discussion['discussion_id'], course_id=CourseKey.from_string(course))
-                if how_often == 'daily':
-                    discussion_model.daily_threads = 0
-                    discussion_model.daily_comment = 0
-                else:
-                    discussion_model.weekly_threads = 0
-                    discussion_model.weekly_comment = 0
-                discussion_model.save()
-                logger.info('EolForumNotification - {} threads/comment count reset, course: {}, discussion_id: {}'.format(how_often, course, discussion['discussion_id']))
-    
+                        if run is not None:
+                            digest_context['idempotency_key'] = '{}:digest:{}'.format(run.id, user['user__id'])
+                        digest_context['discussions'].append(context)
+                    else:
+                        pending.append(context)
+                        if len(pending) >= email_chunk_size:
+                            enqueue(pending)
+                            pending = []
+                report.incr('missing_blocks', len(missing))
+                if digest:
+                    # digests are enqueued at the end of the run, discussions are saved after them
+                    digest_discussions.extend(notified.values())
+                    digest_discussions.extend(missing)
+                    continue
+                # emails are enqueued before the discussions are saved as notified in the run
+                if pending:
+                    enqueue(pending)
+                    pending = []
+                logger.info('EolForumNotification - emails sent, how_often: {}, course: {}, discussions: {}'.format(how_often, course, len(notified)))
+                if not dry_run:
+                    with report.phase('reset_counters'):
+                        save_notified_discussions(run, how_often, list(notified.values()) + missing)
+                    logger.info('EolForumNotification - {} threads/comment count reset, course: {}, discussions: {}'.format(how_often, course, len(notified)))
+        if digest:
+            pending = list(digests.values())
+            dispatch = DispatchScheduler(rate, deadline, len(pending))
+            for i in range(0, len(pending), email_chunk_size):
+                enqueue(pending[i:i + email_chunk_size])
+            logger.info('EolForumNotification - digest emails sent, how_often: {}, users: {}'.format(how_often, len(digests)))
+            if not dry_run:
+                with report.phase('reset_counters'):
+                    for i in range(0, len(digest_discussions), chunk_size):
+                        save_notified_discussions(run, how_often, digest_discussions[i:i + chunk_size])
+        if run is not None:
+            with report.phase('finish_run'):
+                finish_notification_run(run, chunk_size)
+            logger.info('EolForumNotification - run {} finished, how_often: {}'.format(run.id, how_often))
+    if not dry_run:
+        report.send_metrics('send_notification.{}'.format(how_often))
+    return report